@@ -0,0 +1,141 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+import quaternion
+import vmd
+
+
+def _cubic( a, b, u ):
+	v = 1.0 - u
+	return 3.0 * v * v * u * a + 3.0 * v * u * u * b + u * u * u
+
+def _dcubic( a, b, u ):
+	v = 1.0 - u
+	return 3.0 * v * v * a + 6.0 * v * u * (b - a) + 3.0 * u * u * (1.0 - b)
+
+def bezier( x1, y1, x2, y2, x, iters = 8 ):
+	# y at x on the curve (0, 0), (x1, y1), (x2, y2), (1, 1), elementwise.
+	# x(u) is monotonic as 0 <= x1, x2 <= 1, so Newton steps are taken while
+	# they stay inside the bracket and bisection steps otherwise.
+	lo = numpy.zeros_like( x )
+	hi = numpy.ones_like( x )
+	u = x.copy()
+	for _ in range( iters ):
+		f = _cubic( x1, x2, u ) - x
+		lo = numpy.where( f <= 0.0, u, lo )
+		hi = numpy.where( f >= 0.0, u, hi )
+		d = _dcubic( x1, x2, u )
+		n = u - f / numpy.where( d > 1e-6, d, 1.0 )
+		u = numpy.where( (d > 1e-6) & (lo <= n) & (n <= hi), n, (lo + hi) * 0.5 )
+	return _cubic( y1, y2, u )
+
+
+def index( keys, ids, order, offsets, N ):
+	# keys sorted by (track, frame) and (track, frame) packed to be searched
+	# at once for all the tracks.
+	if offsets is None:
+		order, offsets = vmd.tracks( ids, N )
+	keys = keys[order]
+	packed = (ids[order].astype( numpy.int64 ) << 32) + (keys.frame.astype( numpy.int64 ) + (1 << 31))
+	return keys, offsets, packed
+
+def search( keys, offsets, packed, tracks, frame ):
+	# the keys around the frames of the tracks (broadcast together) in the
+	# keys of index(), or the first / last key outside of the track, and the
+	# fraction between them.
+	frame = numpy.asarray( frame, dtype = numpy.float64 )
+	bgn = offsets[tracks]
+	end = offsets[tracks + 1]
+	empty = bgn == end
+	last = numpy.where( empty, 0, end - 1 )
+	query = (tracks.astype( numpy.int64 ) << 32) + (numpy.floor( frame ).astype( numpy.int64 ) + (1 << 31))
+	i1 = numpy.searchsorted( packed, query, side = "right" )
+	i0 = numpy.where( empty, 0, numpy.clip( i1 - 1, bgn, last ) )
+	i1 = numpy.where( empty, 0, numpy.clip( i1, bgn, last ) )
+
+	f0 = keys.frame[i0]
+	f1 = keys.frame[i1]
+	s = numpy.where( f1 > f0, (frame - f0) / numpy.maximum( f1 - f0, 1 ), 0.0 ).astype( numpy.float32 )
+	return i0, i1, s, empty
+
+def interpolate( keys, i0, i1, s ):
+	# locations and rotations between the bone keys of search().
+	c = keys.interp[i1]
+	w = bezier( c[..., 0], c[..., 1], c[..., 2], c[..., 3], numpy.repeat( s[..., None], 4, axis = -1 ) )
+	loc = keys.loc[i0] + (keys.loc[i1] - keys.loc[i0]) * w[..., :3]
+	rot = quaternion.slerp( keys.rot[i0], keys.rot[i1], w[..., 3] )
+	return loc, rot
+
+
+# evaluates the relative pose and the morph weights of a pmx.Loader model by
+# the keyframes of a vmd.Loader motion at any (fractional) frame.  the
+# per-track index of the motion is searched for the tracks bound to the model
+# (see vmd.Binding).
+class Animation( object ):
+
+	def __init__( self, motion, model ):
+		self.motion = motion
+		self.model = model
+		self._bones = None
+		self._skeys = None
+		self.update()
+
+	def update( self ):
+		# a vmd.StreamLoader replaces the keys while loading and publishes the
+		# track index at the end, so the index is read first and the names
+		# (which are added before their keys) last.
+		skeyOffsets = self.motion.skeyOffsets
+		skeyOrder = self.motion.skeyOrder
+		boneOffsets = self.motion.boneOffsets
+		boneOrder = self.motion.boneOrder
+		bones = self.motion.bones
+		skeys = self.motion.skeys
+		if bones is self._bones and skeys is self._skeys:
+			return
+		self.binding = vmd.Binding( self.motion, self.model )
+
+		self.keys, self.offsets, self._packed = index(
+			bones, bones.bone, boneOrder, boneOffsets,
+			max( self.motion.boneMap.values(), default = -1 ) + 1,
+		)
+		self.skeyKeys, self.skeyOffsets, self._skeyPacked = index(
+			skeys, skeys.skey, skeyOrder, skeyOffsets,
+			max( self.motion.skeyMap.values(), default = -1 ) + 1,
+		)
+		self._bones = bones
+		self._skeys = skeys
+
+	def evaluate( self, frame, rRot, rLoc ):
+		# frame may be an array of frames, then rRot and rLoc have its axes
+		# before the bone axis.
+		self.update()
+
+		rRot[:] = [ 1.0, 0.0, 0.0, 0.0 ]
+		rLoc[:] = 0.0
+		tracks = self.binding.boneTracks
+		keys = self.keys
+		if len( keys ) == 0 or len( tracks ) == 0:
+			return
+
+		# bones without keys stay at the rest pose.  frame axes go first.
+		frame = numpy.asarray( frame, dtype = numpy.float64 )[..., None]
+		i0, i1, s, empty = search( keys, self.offsets, self._packed, tracks, frame )
+		loc, rot = interpolate( keys, i0, i1, s )
+		bones = self.binding.bones
+		rLoc[..., bones, :] = numpy.where( empty[..., None], 0.0, loc )
+		rRot[..., bones, :] = numpy.where( empty[..., None], quaternion.identities( 1 ), rot )
+
+	def evaluateMorphs( self, frame, weights ):
+		# morph keys are interpolated linearly.  morphs without keys are 0.
+		self.update()
+
+		weights[:] = 0.0
+		tracks = self.binding.skeyTracks
+		keys = self.skeyKeys
+		if len( keys ) == 0 or len( tracks ) == 0:
+			return
+
+		frame = numpy.asarray( frame, dtype = numpy.float64 )[..., None]
+		i0, i1, s, empty = search( keys, self.skeyOffsets, self._skeyPacked, tracks, frame )
+		val = keys.val[i0] + (keys.val[i1] - keys.val[i0]) * s
+		weights[..., self.binding.skeys] = numpy.where( empty, 0.0, val )
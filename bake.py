@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import os
+import sys
+import multiprocessing
+import numpy
+import skeleton
+import physics
+import ik
+import animation
+import pmx
+import vmd
+import cache
+
+
+def poseType():
+	return numpy.dtype( [
+		("aRot", numpy.float32, (4,)),
+		("aLoc", numpy.float32, (3,)),
+		("aMat", numpy.float32, (4, 4)),
+	] )
+
+def loadPoses( path ):
+	# (frames, bones) poses of bake(), read without computation.
+	return numpy.load( path, mmap_mode = "r" ).view( numpy.recarray )
+
+
+def _state( loader, keys ):
+	# loaders keep open files, so only the needed attributes are sent.
+	return { k: getattr( loader, k ) for k in keys }
+
+def _restore( cls, state ):
+	loader = cls()
+	vars( loader ).update( state )
+	return loader
+
+_worker = None
+
+def _init( path, model, motion, simulate = False ):
+	global _worker
+	model = _restore( pmx.Loader, model )
+	motion = _restore( vmd.Loader, motion )
+	skel = skeleton.Skeleton( model.bones )
+	_worker = (
+		path,
+		skel,
+		animation.Animation( motion, model ),
+		ik.IK( model, skel ),
+		physics.Physics( model, skel ) if simulate else None,
+		len( model.bones ),
+	)
+
+def _bakeRange( frames ):
+	path, skel, anim, solver, phys, N = _worker
+	poses = numpy.load( path, mmap_mode = "r+" )
+	rRot = numpy.empty( (N, 4), numpy.float32 )
+	rLoc = numpy.empty( (N, 3), numpy.float32 )
+	aRot = numpy.empty( (N, 4), numpy.float32 )
+	aLoc = numpy.empty( (N, 3), numpy.float32 )
+	for frame in range( *frames ):
+		anim.evaluate( frame, rRot, rLoc )
+		skel.forward( rRot, rLoc, aRot, aLoc )
+		solver.solve( rRot, rLoc, aRot, aLoc )
+		if phys is not None:
+			phys.step( aRot, aLoc )
+		pose = poses[frame]
+		pose["aRot"] = aRot
+		pose["aLoc"] = aLoc
+		pose["aMat"] = skel.matrices( aRot, aLoc )
+	poses.flush()
+
+
+# evaluates the absolute pose of every (integer) frame of the motion into a
+# memory mapped .npy file of (frames, bones) poseType records, with the IK
+# chains solved (without a time budget) as in playback.  ranges of frames are
+# evaluated by a pool of processes writing to the same file.  if
+# simulate, the physics.Physics of the model is stepped, which needs the
+# frames in order, so they are evaluated by this process.
+def bake( model, motion, path, processes = None, chunk = 64, simulate = False ):
+	# the motion lasts to its last key, of a bone or a morph.
+	last = numpy.concatenate( [ motion.bones.frame, motion.skeys.frame ] )
+	frames = int( last.max() ) + 1 if len( last ) > 0 else 1
+	poses = numpy.lib.format.open_memmap(
+		path, mode = "w+", dtype = poseType(), shape = (frames, len( model.bones )),
+	)
+	del poses
+
+	args = (
+		path,
+		_state( model, [ "bones", "boneMap", "skeyMap", "iks", "ikLinks", "ikOffsets" ] + ([ "rigids", "joints" ] if simulate else []) ),
+		_state( motion, [
+			"boneMap", "skeyMap", "bones", "skeys",
+			"boneOrder", "boneOffsets", "skeyOrder", "skeyOffsets",
+		] ),
+		simulate,
+	)
+	if simulate:
+		processes = 1
+		chunk = frames
+	ranges = [ (bgn, min( bgn + chunk, frames )) for bgn in range( 0, frames, chunk ) ]
+	if processes == 1:
+		_init( *args )
+		for r in ranges:
+			_bakeRange( r )
+	else:
+		with multiprocessing.Pool( processes, _init, args ) as pool:
+			pool.map( _bakeRange, ranges )
+
+
+def main():
+	if len( sys.argv ) != 4:
+		print( "usage: %s model.pmx motion.vmd poses.npy" % sys.argv[0] )
+		sys.exit( 1 )
+
+	store = cache.Cache( os.path.expanduser( "~/.cache/mmd_test_junk" ) )
+	model = store.load( pmx.Loader, sys.argv[1] )
+	motion = store.load( vmd.Loader, sys.argv[2] )
+	bake( model, motion, sys.argv[3] )
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,122 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+import quaternion
+import skeleton
+import animation
+
+
+class Layer( object ):
+
+	def __init__( self, anim, weight, mask, offset, fade ):
+		self.anim   = anim
+		self.weight = weight
+		self.mask   = mask
+		self.offset = offset
+		self.fade   = fade
+
+
+# layers of motions for one pmx.Loader model.  from the rest pose, each layer
+# in the order of addition is blended over the result by its weight times its
+# per-bone mask (if any): the rotations by slerp and the locations linearly,
+# for all the bones at once.  a layer may fade in over (start, length) frames.
+# layers under one of full weight on every bone are not evaluated.
+# like animation.Animation, it has update() and (motion, binding) identifying
+# its poses, so it may be cached by posecache.PoseCache; the masks are not to
+# be modified in place.
+class Blend( object ):
+
+	def __init__( self, model ):
+		self.model = model
+		self.skeleton = skeleton.Skeleton( model.bones )
+		self.layers = []
+		self._alloc()
+		self.update()
+
+	def update( self ):
+		for layer in self.layers:
+			layer.anim.update()
+		self.motion = self
+		self.binding = tuple(
+			(layer, layer.anim.binding, layer.weight, layer.offset, layer.fade)
+			for layer in self.layers
+		)
+
+	def add( self, motion, weight = 1.0, mask = None, offset = 0.0, fade = None ):
+		self.layers.append( Layer(
+			animation.Animation( motion, self.model ), weight,
+			None if mask is None else numpy.asarray( mask, dtype = numpy.float32 ),
+			offset, fade,
+		) )
+		self._alloc()
+		return self.layers[-1]
+
+	def remove( self, layer ):
+		self.layers.remove( layer )
+		self._alloc()
+
+	def crossfade( self, motion, frame, length, offset = 0.0 ):
+		# fades the motion in from the frame.  the layers it covers are not
+		# evaluated once it is complete, and are dropped by prune().
+		return self.add( motion, offset = offset, fade = (frame, length) )
+
+	def prune( self, frame ):
+		# removes the layers under the bottom one evaluate() uses.
+		bottom = self._bottom( self._weights( frame ) )
+		if bottom > 0:
+			del self.layers[:bottom]
+			self._alloc()
+
+	def subtree( self, names ):
+		# mask of the named bones and their descendants.
+		mask = numpy.zeros( (self.model.bones.shape[0],), numpy.float32 )
+		for name in names:
+			if name in self.model.boneMap:
+				mask[self.model.boneMap[name]] = 1.0
+		for (idx, parent) in self.skeleton.levels[1:]:
+			mask[idx] = numpy.maximum( mask[idx], mask[parent] )
+		return mask
+
+	def _alloc( self ):
+		L = len( self.layers )
+		N = self.model.bones.shape[0]
+		self._rRot = numpy.empty( (L, N, 4), numpy.float32 )
+		self._rLoc = numpy.empty( (L, N, 3), numpy.float32 )
+		self._morphs = numpy.empty( (L, self.model.morphs.shape[0]), numpy.float32 )
+
+	def _weight( self, layer, frame ):
+		s = layer.weight
+		if layer.fade is not None:
+			start, length = layer.fade
+			s *= min( max( (frame - start) / length, 0.0 ), 1.0 ) if length > 0 else float( frame >= start )
+		return s
+
+	def _weights( self, frame ):
+		# (layers, bones) blend weights at the frame.
+		w = numpy.empty( self._rLoc.shape[:2], numpy.float32 )
+		for (l, layer) in enumerate( self.layers ):
+			s = self._weight( layer, frame )
+			w[l] = s if layer.mask is None else s * layer.mask
+		return w
+
+	def _bottom( self, w ):
+		opaque = numpy.nonzero( numpy.all( w >= 1.0, axis = 1 ) )[0]
+		return opaque[-1] if len( opaque ) > 0 else 0
+
+	def evaluate( self, frame, rRot, rLoc ):
+		w = self._weights( frame )
+		rRot[:] = [ 1.0, 0.0, 0.0, 0.0 ]
+		rLoc[:] = 0.0
+		for l in range( self._bottom( w ), len( self.layers ) ):
+			layer = self.layers[l]
+			layer.anim.evaluate( frame + layer.offset, self._rRot[l], self._rLoc[l] )
+			quaternion.slerp( rRot, self._rRot[l], w[l], out = rRot )
+			rLoc += (self._rLoc[l] - rLoc) * w[l][:, None]
+
+	def evaluateMorphs( self, frame, weights ):
+		# morph weights are blended linearly by the layer weights (not masked).
+		weights[:] = 0.0
+		for (l, layer) in enumerate( self.layers ):
+			s = self._weight( layer, frame )
+			layer.anim.evaluateMorphs( frame + layer.offset, self._morphs[l] )
+			weights += (self._morphs[l] - weights) * s
@@ -0,0 +1,92 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+
+
+def frustum( m ):
+	# the planes (6, 4) of the clip volume of the 4x4 matrix m (column
+	# vectors): points p inside are dot( plane, (p, 1) ) >= 0 for all.
+	m = numpy.asarray( m, dtype = numpy.float64 )
+	return numpy.array( [
+		m[3] + m[0], m[3] - m[0],
+		m[3] + m[1], m[3] - m[1],
+		m[3] + m[2], m[3] - m[2],
+	] )
+
+def outside( planes, lo, hi ):
+	# whether the boxes (..., 3) are entirely outside of one of the planes,
+	# by their corners farthest along the normals.
+	n = planes[:, :3]
+	far = numpy.where( n >= 0.0, hi[..., None, :], lo[..., None, :] )
+	return numpy.any( numpy.sum( n * far, axis = -1 ) + planes[:, 3] < 0.0, axis = -1 )
+
+
+# bounding spheres of a pmx.Loader model per material and bone, in the rest
+# pose, of the vertices weighted by the bone and padded by the offsets of the
+# vertex morphs.  a linearly skinned vertex is a blend of its points moved by
+# its bones, which are in the moved spheres, so the boxes of the moved spheres
+# bound the materials.  an SDEF vertex (see skinning.Skinning) is off that
+# blend by at most |p - C| + max |Cr - p| of its point p, rotation center C
+# and side centers Cr (and twice its morph offsets), by which it is padded.
+class Bounds( object ):
+
+	def __init__( self, model ):
+		verts, weights = model.vertices()
+		verts = numpy.asarray( verts.vert, dtype = numpy.float64 )
+		faces = numpy.asarray( model.faces, dtype = numpy.int64 )
+		M = len( model.materials )
+		NB = max( len( model.bones ), 1 )
+		pad = numpy.zeros( (len( verts ),), numpy.float64 )
+		morphs = model.vertMorphs
+		numpy.add.at( pad, morphs.vert, numpy.sqrt( numpy.sum( numpy.square( morphs.offset, dtype = numpy.float64 ), axis = -1 ) ) )
+		sdef = numpy.nonzero( weights.type == 3 )[0]
+		if len( sdef ) > 0:
+			p = verts[sdef]
+			w = numpy.asarray( weights.weight[sdef, :2], dtype = numpy.float64 )
+			c, r0, r1 = numpy.asarray( weights.sdef[sdef], dtype = numpy.float64 ).transpose( (1, 0, 2) )
+			rw = r0 * w[:, 0:1] + r1 * w[:, 1:2]
+			side = numpy.maximum(
+				numpy.linalg.norm( c + (r0 - rw) * 0.5 - p, axis = -1 ),
+				numpy.linalg.norm( c + (r1 - rw) * 0.5 - p, axis = -1 ),
+			)
+			pad[sdef] = pad[sdef] * 3.0 + numpy.linalg.norm( p - c, axis = -1 ) + side
+
+		# (material, bone, vertex) of every weight of the vertices drawn.
+		pairs = []
+		for (i, m) in enumerate( model.materials ):
+			v = numpy.unique( faces[m.bgn // 3 : m.end // 3] )
+			w = (weights.weight[v] > 0.0) & (weights.bone[v] >= 0)
+			k, s = numpy.nonzero( w )
+			pairs.append( numpy.stack( [ i * NB + weights.bone[v[k], s], v[k] ], axis = -1 ) )
+		pairs = numpy.concatenate( [ numpy.zeros( (0, 2), numpy.int64 ) ] + pairs )
+		pairs = numpy.unique( pairs, axis = 0 )
+		keys, starts = numpy.unique( pairs[:, 0], return_index = True )
+
+		p = verts[pairs[:, 1]]
+		if len( keys ) > 0:
+			center = (numpy.minimum.reduceat( p, starts ) + numpy.maximum.reduceat( p, starts )) * 0.5
+			dist = numpy.sqrt( numpy.sum( (p - numpy.repeat( center, numpy.diff( starts, append = len( p ) ), axis = 0 )) ** 2, axis = -1 ) )
+			radius = numpy.maximum.reduceat( dist + pad[pairs[:, 1]], starts )
+		else:
+			center = numpy.zeros( (0, 3) )
+			radius = numpy.zeros( (0,) )
+		self.bone = (keys % NB).astype( numpy.int32 )
+		self.center = center.astype( numpy.float32 )
+		self.radius = radius.astype( numpy.float32 )
+		# the spheres of the material i are [offsets[i], offsets[i + 1]).
+		self.offsets = numpy.searchsorted( keys // NB, numpy.arange( M + 1 ) )
+
+	def update( self, aMat ):
+		# the boxes (lo, hi) of the materials (..., materials, 3) by the
+		# matrices of skeleton.Skeleton.matrices, which may have leading
+		# axes.  materials without vertices are empty boxes (lo > hi).
+		m = aMat[..., self.bone, :, :]
+		c = numpy.einsum( "...ij,...j->...i", m[..., :3, :3], self.center ) + m[..., :3, 3]
+		M = len( self.offsets ) - 1
+		lo = numpy.full( aMat.shape[:-3] + (M, 3), numpy.inf, numpy.float32 )
+		hi = numpy.full( aMat.shape[:-3] + (M, 3), -numpy.inf, numpy.float32 )
+		full = self.offsets[:-1] < self.offsets[1:]
+		if numpy.any( full ):
+			lo[..., full, :] = numpy.minimum.reduceat( c - self.radius[:, None], self.offsets[:-1][full], axis = -2 )
+			hi[..., full, :] = numpy.maximum.reduceat( c + self.radius[:, None], self.offsets[:-1][full], axis = -2 )
+		return lo, hi
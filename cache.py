@@ -0,0 +1,108 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import os
+import shutil
+import pickle
+import hashlib
+import tempfile
+import numpy
+
+
+def fileHash( path ):
+	h = hashlib.blake2b( digest_size = 20 )
+	with open( path, "rb" ) as f:
+		for chunk in iter( lambda: f.read( 1 << 20 ), b"" ):
+			h.update( chunk )
+	return h.hexdigest()
+
+def argHash( args ):
+	h = hashlib.blake2b( digest_size = 20 )
+	for a in args:
+		# dicts (boneMap, skeyMap) are keyed by content, not insertion order.
+		h.update( repr( sorted( a.items() ) if isinstance( a, dict ) else a ).encode() )
+		h.update( b"\0" )
+	return h.hexdigest()
+
+
+# a directory of parsed loaders keyed by the source content, the loader class
+# and its version.  arrays are stored as .npy files and loaded by memory
+# mapping, the other public attributes are pickled.
+class Cache( object ):
+
+	def __init__( self, root, maxSize = 1 << 30, mapped = True ):
+		self.root = root
+		self.maxSize = maxSize
+		self.mapped = mapped
+		os.makedirs( root, exist_ok = True )
+
+	def load( self, cls, path, *args ):
+		key = "%s.%s-%d-%s-%s" % (
+			cls.__module__, cls.__name__, cls.version, fileHash( path ), argHash( args ),
+		)
+		loader = self._get( cls, key )
+		if loader is None:
+			loader = cls()
+			with open( path, "rb" ) as f:
+				loader.load( f, *args )
+			self._put( key, loader )
+		return loader
+
+	def _get( self, cls, key ):
+		dst = os.path.join( self.root, key )
+		try:
+			with open( os.path.join( dst, "state.pickle" ), "rb" ) as f:
+				state = pickle.load( f )
+			for name in state.pop( "_arrays" ):
+				a = numpy.load(
+					os.path.join( dst, name + ".npy" ),
+					mmap_mode = "r" if self.mapped else None,
+				)
+				state[name] = a.view( numpy.recarray ) if a.dtype.names is not None else a
+		except FileNotFoundError:
+			return None
+		except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError, AttributeError, pickle.UnpicklingError):
+			# a corrupt or truncated entry is dropped and parsed again.
+			shutil.rmtree( dst, ignore_errors = True )
+			return None
+
+		os.utime( dst )
+		loader = cls()
+		vars( loader ).update( state )
+		return loader
+
+	def _put( self, key, loader ):
+		state = { k: v for (k, v) in vars( loader ).items() if not k.startswith( "_" ) }
+		arrays = [ k for (k, v) in state.items() if isinstance( v, numpy.ndarray ) ]
+
+		tmp = tempfile.mkdtemp( dir = self.root, prefix = ".tmp-" )
+		try:
+			for name in arrays:
+				numpy.save( os.path.join( tmp, name + ".npy" ), numpy.asarray( state.pop( name ) ) )
+			state["_arrays"] = arrays
+			with open( os.path.join( tmp, "state.pickle" ), "wb" ) as f:
+				pickle.dump( state, f, pickle.HIGHEST_PROTOCOL )
+			os.rename( tmp, os.path.join( self.root, key ) )
+		except OSError:
+			# another process may have stored the same entry meanwhile.
+			shutil.rmtree( tmp, ignore_errors = True )
+			return
+
+		self._evict()
+
+	def _evict( self ):
+		entries = []
+		total = 0
+		for name in os.listdir( self.root ):
+			dst = os.path.join( self.root, name )
+			if name.startswith( "." ) or not os.path.isdir( dst ):
+				continue
+			size = sum( e.stat().st_size for e in os.scandir( dst ) )
+			entries.append( (os.stat( dst ).st_mtime, size, dst) )
+			total += size
+
+		# least recently used first.
+		for (_, size, dst) in sorted( entries ):
+			if total <= self.maxSize:
+				break
+			shutil.rmtree( dst, ignore_errors = True )
+			total -= size
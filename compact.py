@@ -0,0 +1,213 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+import quaternion
+import animation
+import vmd
+
+
+# smallest three: the largest component (by magnitude) of a unit quaternion
+# is dropped after flipping it positive, and the others, which are within
+# +-1 / sqrt( 2 ), are quantized to 16 bits.
+_rotScale = 65535.0 / numpy.sqrt( 2.0 )
+
+def packRotations( q ):
+	axis = numpy.argmax( numpy.abs( q ), axis = -1 )
+	q = q * numpy.where( numpy.take_along_axis( q, axis[..., None], -1 ) < 0.0, -1.0, 1.0 )
+	rest = numpy.array( [ [ 1, 2, 3 ], [ 0, 2, 3 ], [ 0, 1, 3 ], [ 0, 1, 2 ] ] )[axis]
+	small = numpy.take_along_axis( q, rest, -1 )
+	rot = numpy.clip( numpy.rint( (small + 1.0 / numpy.sqrt( 2.0 )) * _rotScale ), 0, 65535 )
+	return rot.astype( numpy.uint16 ), axis.astype( numpy.uint8 )
+
+def unpackRotations( rot, axis ):
+	small = rot.astype( numpy.float32 ) * numpy.float32( 1.0 / _rotScale ) - numpy.float32( 1.0 / numpy.sqrt( 2.0 ) )
+	large = numpy.sqrt( numpy.maximum( 1.0 - numpy.einsum( "...i,...i->...", small, small ), 0.0 ) )
+	q = numpy.empty( rot.shape[:-1] + (4,), numpy.float32 )
+	rest = numpy.array( [ [ 1, 2, 3 ], [ 0, 2, 3 ], [ 0, 1, 3 ], [ 0, 1, 2 ] ] )[axis]
+	numpy.put_along_axis( q, rest, small, -1 )
+	numpy.put_along_axis( q, axis[..., None].astype( numpy.intp ), large[..., None], -1 )
+	return q
+
+
+def _ranges( bgn, cnt ):
+	# concatenation of arange( bgn[i], bgn[i] + cnt[i] ).
+	return numpy.repeat( bgn - numpy.cumsum( cnt ) + cnt, cnt ) + numpy.arange( cnt.sum() )
+
+def _angles( x, y ):
+	d = quaternion.dot(
+		quaternion.normalize( x.astype( numpy.float64 ) ),
+		quaternion.normalize( y.astype( numpy.float64 ) ),
+	)
+	return 2.0 * numpy.arccos( numpy.minimum( numpy.abs( d ), 1.0 ) )
+
+
+# the bone keys of a vmd.Loader with the keys the interpolation reproduces
+# within posTol (in model units) and angleTol (in radians) removed, and the
+# others stored as:
+#   - the first frame of each track and the deltas to the previous key,
+#   - the locations as float32,
+#   - the rotations by packRotations,
+#   - the curves as the original 7 bit values.
+# the motion is sampled at every integer frame of each track, and a key is
+# removed if the linear interpolation of its neighbors is within the
+# tolerances at every sample between them.  the segments over removed keys
+# become linear.  the morph keys are kept as they are: they are few and
+# already small, and are not counted below.
+#
+# ratio is the size of the bone keys as (frame, bone, loc, rot) records of
+# int32, int32, float32 x 3, float32 x 4 (36 bytes, like the file) over that
+# of the compact keys, both without the curves.  posError / angleError are
+# the maximum errors of the decoded motion at the samples, which include the
+# rotation quantization (about 5e-5 radians).
+class CompactMotion( object ):
+
+	linear = numpy.array( [ 20, 20, 107, 107 ], dtype = numpy.uint8 )
+
+	# (frame, bone, loc, rot) of a bone key in bytes, the base of ratio
+	recordSize = 4 + 4 + 3 * 4 + 4 * 4
+
+	def __init__( self, motion, posTol = 1e-3, angleTol = 1e-3 ):
+		self.boneMap = dict( motion.boneMap )
+		self.skeyMap = dict( motion.skeyMap )
+		self.skeys = motion.skeys
+		N = max( self.boneMap.values(), default = -1 ) + 1
+		keys, offsets, packed = animation.index(
+			motion.bones, motion.bones.bone, motion.boneOrder, motion.boneOffsets, N,
+		)
+		samples = self._samples( keys, offsets, packed )
+		keep = self._reduce( keys, offsets, samples, posTol, angleTol )
+
+		idx = numpy.nonzero( keep )[0]
+		track = numpy.repeat( numpy.arange( N ), numpy.diff( offsets ) )[idx]
+		self.offsets = numpy.zeros( (N + 1,), numpy.int64 )
+		numpy.cumsum( numpy.bincount( track, minlength = N ), out = self.offsets[1:] )
+		self.first = samples[0].astype( numpy.int32 )
+
+		# the first keys of the tracks have delta 0.
+		heads = self.offsets[:-1][numpy.diff( self.offsets ) > 0]
+		delta = numpy.diff( keys.frame[idx], prepend = 0 )
+		delta[heads] = 0
+		interp = numpy.rint( keys.interp[idx] * 127.0 ).astype( numpy.uint8 )
+		# the keys whose previous key is removed end linear segments.
+		merged = numpy.diff( idx, prepend = -1 ) > 1
+		merged[heads] = False
+		interp[merged] = self.linear
+
+		rot, axis = packRotations( keys.rot[idx] )
+		self.keys = numpy.recarray( idx.shape, dtype = [
+			("delta",  numpy.uint16 if delta.max( initial = 0 ) < (1 << 16) else numpy.uint32),
+			("loc",    numpy.float32, (3,)),
+			("rot",    numpy.uint16, (3,)),
+			("axis",   numpy.uint8),
+			("interp", numpy.uint8, (4, 4)),
+		] )
+		self.keys.delta  = delta
+		self.keys.loc    = keys.loc[idx]
+		self.keys.rot    = rot
+		self.keys.axis   = axis
+		self.keys.interp = interp
+
+		size = self.keys.nbytes - self.keys.interp.nbytes + self.offsets.nbytes + self.first.nbytes
+		self.ratio = len( motion.bones ) * self.recordSize / max( size, 1 )
+		self.posError, self.angleError = self._errors( samples )
+
+	def decode( self ):
+		# a vmd.Loader of the compact keys, vectorized.
+		N = len( self.offsets ) - 1
+		track = numpy.repeat( numpy.arange( N, dtype = numpy.int32 ), numpy.diff( self.offsets ) )
+		frame = numpy.cumsum( self.keys.delta.astype( numpy.int64 ) )
+		frame += self.first[track] - frame[self.offsets[track]]
+
+		bones = numpy.recarray( self.keys.shape, dtype = vmd.boneType )
+		bones.frame  = frame
+		bones.bone   = track
+		bones.loc    = self.keys.loc
+		bones.rot    = unpackRotations( self.keys.rot, self.keys.axis )
+		bones.interp = self.keys.interp / numpy.float32( 127.0 )
+
+		motion = vmd.Loader()
+		motion.boneMap = dict( self.boneMap )
+		motion.skeyMap = dict( self.skeyMap )
+		motion.bones = bones[numpy.argsort( bones.frame, kind = "stable" )]
+		motion.skeys = self.skeys
+		motion.boneOrder, motion.boneOffsets = vmd.tracks( motion.bones.bone, N )
+		motion.skeyOrder, motion.skeyOffsets = vmd.tracks( motion.skeys.skey, max( self.skeyMap.values(), default = -1 ) + 1 )
+		return motion
+
+	def _samples( self, keys, offsets, packed ):
+		# the original motion at every integer frame from the first to the
+		# last key of each track.
+		N = len( offsets ) - 1
+		cnt = numpy.diff( offsets )
+		has = cnt > 0
+		first = numpy.zeros( (N,), numpy.int64 )
+		last = numpy.full( (N,), -1, numpy.int64 )
+		first[has] = keys.frame[offsets[:-1][has]]
+		last[has] = keys.frame[offsets[1:][has] - 1]
+		sOffsets = numpy.zeros( (N + 1,), numpy.int64 )
+		numpy.cumsum( last - first + 1, out = sOffsets[1:] )
+
+		track = numpy.repeat( numpy.arange( N ), last - first + 1 )
+		frame = _ranges( first, last - first + 1 )
+		i0, i1, s, _ = animation.search( keys, offsets, packed, track, frame )
+		loc, rot = animation.interpolate( keys, i0, i1, s )
+		return (first, sOffsets, track, frame, loc, rot)
+
+	def _reduce( self, keys, offsets, samples, posTol, angleTol ):
+		# removes every other removable key of each track per pass, so that
+		# the neighbors of the removed keys are kept.
+		first, sOffsets, _, _, sLoc, sRot = samples
+		track = numpy.repeat( numpy.arange( len( offsets ) - 1 ), numpy.diff( offsets ) )
+		keep = numpy.ones( (len( keys ),), bool )
+		idle = 0
+		parity = 0
+		while idle < 2:
+			kept = numpy.nonzero( keep )[0]
+			kt = track[kept]
+			start = numpy.searchsorted( kt, kt )
+			rank = numpy.arange( len( kept ) ) - start
+			inner = numpy.zeros( (len( kept ),), bool )
+			inner[1:-1] = (kt[:-2] == kt[1:-1]) & (kt[1:-1] == kt[2:])
+			j = numpy.nonzero( inner & (rank % 2 == parity) )[0]
+			parity ^= 1
+
+			p = kept[j - 1]
+			n = kept[j + 1]
+			t = kt[j]
+			fp = keys.frame[p].astype( numpy.int64 )
+			fn = keys.frame[n].astype( numpy.int64 )
+			cnt = numpy.maximum( fn - fp - 1, 0 )
+			at = _ranges( sOffsets[t] + fp - first[t] + 1, cnt )
+			owner = numpy.repeat( numpy.arange( len( j ) ), cnt )
+			local = numpy.arange( cnt.sum() ) - numpy.repeat( numpy.cumsum( cnt ) - cnt, cnt )
+
+			# the samples strictly between the neighbors.
+			u = ((local + 1) / (fn - fp)[owner]).astype( numpy.float32 )
+			p = p[owner]
+			n = n[owner]
+			loc = keys.loc[p] + (keys.loc[n] - keys.loc[p]) * u[:, None]
+			rot = quaternion.slerp( keys.rot[p], keys.rot[n], u )
+
+			posErr = numpy.zeros( (len( j ),) )
+			angErr = numpy.zeros( (len( j ),) )
+			numpy.maximum.at( posErr, owner, numpy.linalg.norm( loc - sLoc[at], axis = -1 ) )
+			numpy.maximum.at( angErr, owner, _angles( rot, sRot[at] ) )
+			drop = (posErr <= posTol) & (angErr <= angleTol)
+			keep[kept[j[drop]]] = False
+			idle = 0 if drop.any() else idle + 1
+		return keep
+
+	def _errors( self, samples ):
+		_, _, track, frame, sLoc, sRot = samples
+		if len( track ) == 0:
+			return 0.0, 0.0
+		motion = self.decode()
+		keys, offsets, packed = animation.index(
+			motion.bones, motion.bones.bone, motion.boneOrder, motion.boneOffsets, len( self.offsets ) - 1,
+		)
+		i0, i1, s, _ = animation.search( keys, offsets, packed, track, frame )
+		loc, rot = animation.interpolate( keys, i0, i1, s )
+		return (
+			float( numpy.linalg.norm( loc - sLoc, axis = -1 ).max() ),
+			float( _angles( rot, sRot ).max() ),
+		)
@@ -0,0 +1,137 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import sys
+import time
+import numpy
+import quaternion
+import skeleton
+import animation
+import ik
+import bounds
+import pmx
+import vmd
+
+
+# many instances of one pmx.Loader model, each with its own motion, time
+# offset and root transform.  the skeleton is shared and the poses of all the
+# instances are (instances, bones) arrays, so forward kinematics and the IK
+# chains cost the same number of batched operations as a single instance.
+# instances of the same motion are evaluated together.
+class Crowd( object ):
+
+	def __init__( self, model ):
+		self.model = model
+		self.skeleton = skeleton.Skeleton( model.bones )
+		self.ik = ik.IK( model, self.skeleton )
+		self.bounds = bounds.Bounds( model )
+		self.offsets = numpy.zeros( (0,), numpy.float64 )
+		self.rootRot = quaternion.identities( 0 )
+		self.rootLoc = numpy.zeros( (0, 3), numpy.float32 )
+		self._motions = []
+		self._groups = {}
+		self._alloc()
+
+	def add( self, motion, offset = 0.0, rootRot = (1.0, 0.0, 0.0, 0.0), rootLoc = (0.0, 0.0, 0.0) ):
+		i = len( self.offsets )
+		self.offsets = numpy.append( self.offsets, offset )
+		self.rootRot = numpy.append( self.rootRot, [ rootRot ], axis = 0 ).astype( numpy.float32 )
+		self.rootLoc = numpy.append( self.rootLoc, [ rootLoc ], axis = 0 ).astype( numpy.float32 )
+
+		key = id( motion )
+		if key not in self._groups:
+			self._motions.append( motion ) # keeps the id unique
+			self._groups[key] = (animation.Animation( motion, self.model ), [])
+		self._groups[key][1].append( i )
+		self._alloc()
+		return i
+
+	def _alloc( self ):
+		I = len( self.offsets )
+		N = self.model.bones.shape[0]
+		self.rRot = numpy.empty( (I, N, 4), numpy.float32 )
+		self.rLoc = numpy.empty( (I, N, 3), numpy.float32 )
+		self.aRot = numpy.empty( (I, N, 4), numpy.float32 )
+		self.aLoc = numpy.empty( (I, N, 3), numpy.float32 )
+		self.aMat = numpy.empty( (I, N, 4, 4), numpy.float32 )
+		self._index = [
+			(anim, numpy.array( idx, dtype = numpy.intp ))
+			for (anim, idx) in self._groups.values()
+		]
+
+	def update( self, frame ):
+		# poses of all the instances at frame + offsets.
+		frames = frame + self.offsets
+		for (anim, idx) in self._index:
+			rRot = self.rRot[idx]
+			rLoc = self.rLoc[idx]
+			anim.evaluate( frames[idx], rRot, rLoc )
+			self.rRot[idx] = rRot
+			self.rLoc[idx] = rLoc
+
+		# the root transform applies to the root bones, and so to all.
+		roots = self.skeleton.levels[0][0] if len( self.skeleton.levels ) > 0 else []
+		self.rRot[:, roots] = quaternion.mul( self.rootRot[:, None], self.rRot[:, roots] )
+		self.rLoc[:, roots] = (
+			quaternion.transform( self.rootRot[:, None], self.skeleton.offsets[roots] + self.rLoc[:, roots] ) +
+			self.rootLoc[:, None] - self.skeleton.offsets[roots]
+		)
+
+		self.skeleton.forward( self.rRot, self.rLoc, self.aRot, self.aLoc )
+		self.ik.solve( self.rRot, self.rLoc, self.aRot, self.aLoc )
+		self.skeleton.matrices( self.aRot, self.aLoc, self.aMat )
+
+	def visible( self, planes ):
+		# (instances, materials) mask of the materials in the frustum planes
+		# (see bounds.frustum) at the last update.  instances of no visible
+		# material need neither skinning nor drawing.
+		lo, hi = self.bounds.update( self.aMat )
+		return ~bounds.outside( planes, lo, hi )
+
+
+def main():
+	# the time of an update of a crowd against updating its instances one by
+	# one, as in playback.
+	if len( sys.argv ) < 4:
+		print( "usage: %s instances model.pmx motion.vmd..." % sys.argv[0] )
+		sys.exit( 1 )
+
+	I = int( sys.argv[1] )
+	model = pmx.Loader()
+	with open( sys.argv[2], "rb" ) as f:
+		model.load( f )
+	motions = []
+	for path in sys.argv[3:]:
+		motions.append( vmd.Loader() )
+		with open( path, "rb" ) as f:
+			motions[-1].load( f )
+
+	crowd = Crowd( model )
+	for i in range( I ):
+		crowd.add( motions[i % len( motions )], offset = 7.0 * i, rootLoc = (10.0 * i, 0.0, 0.0) )
+	frames = numpy.arange( 0.0, 100.0, 0.5 )
+	t = time.perf_counter()
+	for frame in frames:
+		crowd.update( frame )
+	tCrowd = (time.perf_counter() - t) / len( frames )
+
+	skel = crowd.skeleton
+	solver = ik.IK( model, skel )
+	anims = [ animation.Animation( m, model ) for m in motions ]
+	N = model.bones.shape[0]
+	rRot = numpy.empty( (N, 4), numpy.float32 )
+	rLoc = numpy.empty( (N, 3), numpy.float32 )
+	aRot = numpy.empty( (N, 4), numpy.float32 )
+	aLoc = numpy.empty( (N, 3), numpy.float32 )
+	t = time.perf_counter()
+	for frame in frames:
+		for i in range( I ):
+			anims[i % len( anims )].evaluate( frame + 7.0 * i, rRot, rLoc )
+			skel.forward( rRot, rLoc, aRot, aLoc )
+			solver.solve( rRot, rLoc, aRot, aLoc )
+			skel.matrices( aRot, aLoc )
+	tEach = (time.perf_counter() - t) / len( frames )
+	print( "%d instances: %.2f ms per update, %.2f ms one by one" % (I, tCrowd * 1e3, tEach * 1e3) )
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,192 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import time
+import numpy
+import quaternion
+
+
+def _axisAngle( axis, theta ):
+	q = numpy.empty( theta.shape + (4,), numpy.float32 )
+	q[..., 0] = numpy.cos( theta * 0.5 )
+	q[..., 1:] = axis * numpy.sin( theta * 0.5 )[..., None]
+	return q
+
+def clampEuler( q, lower, upper ):
+	# q as rotations about X, Y then Z of R = Rx Ry Rz, each clamped.
+	m = quaternion.matrix4( q )
+	y = numpy.arcsin( numpy.clip( m[..., 0, 2], -1.0, 1.0 ) )
+	x = numpy.arctan2( -m[..., 1, 2], m[..., 2, 2] )
+	z = numpy.arctan2( -m[..., 0, 1], m[..., 0, 0] )
+	e = numpy.clip( numpy.stack( [ x, y, z ], axis = -1 ), lower, upper )
+	unit = numpy.eye( 3, dtype = numpy.float32 )
+	return quaternion.mul(
+		quaternion.mul( _axisAngle( unit[0], e[..., 0] ), _axisAngle( unit[1], e[..., 1] ) ),
+		_axisAngle( unit[2], e[..., 2] ),
+	)
+
+
+class _Stage( object ):
+
+	# IK chains solved together, as arrays padded to the longest chain.
+	def __init__( self, chains ):
+		C = len( chains )
+		P = max( len( c["path"] ) for c in chains )
+		K = max( len( c["links"] ) for c in chains )
+		self.goal   = numpy.array( [ c["goal"] for c in chains ], numpy.int32 )
+		self.target = numpy.array( [ c["target"] for c in chains ], numpy.int32 )
+		self.loops  = numpy.array( [ c["loops"] for c in chains ], numpy.int32 )
+		self.limit  = numpy.array( [ c["limit"] for c in chains ], numpy.float32 )
+		self.tol    = numpy.array( [ c["tol"] for c in chains ], numpy.float32 )
+		self.path   = numpy.zeros( (C, P), numpy.int32 )
+		self.valid  = numpy.zeros( (C, P), bool )
+		self.linkAt = numpy.full( (C, K), -1, numpy.int32 )
+		self.limited = numpy.zeros( (C, K), bool )
+		self.lower  = numpy.zeros( (C, K, 3), numpy.float32 )
+		self.upper  = numpy.zeros( (C, K, 3), numpy.float32 )
+		for (i, c) in enumerate( chains ):
+			self.path[i, :len( c["path"] )] = c["path"]
+			self.valid[i, :len( c["path"] )] = True
+			for (k, (at, link)) in enumerate( c["links"] ):
+				self.linkAt[i, k] = at
+				self.limited[i, k] = link.limited
+				self.lower[i, k] = link.lower
+				self.upper[i, k] = link.upper
+
+
+# CCD solver of the IK chains of a pmx.Loader (see pmx.Loader.iks), run after
+# skeleton.Skeleton.forward.  the chains are grouped into stages of
+# independent chains, and the chains of a stage are solved at once: each step
+# rotates the k-th link of every chain, and the bones between the link and
+# the target are moved rigidly instead of by forward kinematics.  the
+# absolute pose is recomputed after each stage.
+#
+# a chain stops when the target is within 1e-3 of its reach from the goal.
+# the number of iterations per stage is bounded by the loops of each chain
+# and by maxLoops; the whole solve stops at the budget (in seconds) even if
+# the chains have not converged.  loops counts the iterations of the last
+# solve, and truncated tells whether it was stopped by the budget.  poses
+# may have leading axes, e.g. (instances, bones, 4), which are solved at once.
+class IK( object ):
+
+	def __init__( self, model, skel, budget = None, maxLoops = None ):
+		self.skeleton = skel
+		self.budget = budget
+		self.maxLoops = maxLoops
+		parents = skel.parents
+		chains = []
+		for k in range( model.iks.shape[0] ):
+			ik = model.iks[k]
+			# chains without a target bone have nothing to solve.
+			if ik.target < 0:
+				continue
+			up = [ int( ik.target ) ]
+			while parents[up[-1]] >= 0:
+				up.append( int( parents[up[-1]] ) )
+			depth = { b: n for (n, b) in enumerate( up ) }
+
+			# links which are not ancestors of the target have no effect.
+			links = [
+				l for l in model.ikLinks[model.ikOffsets[k] : model.ikOffsets[k + 1]]
+				if int( l.bone ) in depth and int( l.bone ) != ik.target
+			]
+			if len( links ) == 0:
+				continue
+			top = max( depth[int( l.bone )] for l in links )
+			reach = numpy.linalg.norm( skel.offsets[up[:top]], axis = -1 ).sum()
+			chains.append( {
+				"goal":   int( ik.bone ),
+				"target": int( ik.target ),
+				"loops":  int( ik.loops ),
+				"limit":  float( ik.limit ),
+				"tol":    1e-3 * reach, # converged distance
+				"path":   up[top::-1], # from the top link down to the target
+				"links":  [ (top - depth[int( l.bone )], l) for l in links ],
+			} )
+
+		# a chain depends on the earlier ones whose links move its bones.
+		def moves( a, b ):
+			bones = set( b["path"] ) | { b["goal"] }
+			for bone in bones:
+				while bone >= 0:
+					if any( a["path"][at] == bone for (at, _) in a["links"] ):
+						return True
+					bone = parents[bone]
+			return False
+
+		stages = []
+		for (i, c) in enumerate( chains ):
+			c["stage"] = max( (a["stage"] + 1 for a in chains[:i] if moves( a, c )), default = 0 )
+			if c["stage"] == len( stages ):
+				stages.append( [] )
+			stages[c["stage"]].append( c )
+		self.stages = [ _Stage( s ) for s in stages ]
+		self.loops = 0
+		self.truncated = False
+
+	def solve( self, rRot, rLoc, aRot, aLoc ):
+		# rRot of the links is updated, and aRot, aLoc are recomputed.
+		deadline = None if self.budget is None else time.perf_counter() + self.budget
+		self.loops = 0
+		self.truncated = False
+		for stage in self.stages:
+			self._solve( stage, rRot, aRot, aLoc, deadline )
+			self.skeleton.forward( rRot, rLoc, aRot, aLoc )
+
+	def _solve( self, st, rRot, aRot, aLoc, deadline ):
+		# poses may have leading axes; the chains which have converged (or
+		# run out of their loops) in an instance keep their rotations.
+		parents = self.skeleton.parents
+		goal = aLoc[..., st.goal, :].copy()
+		active = numpy.ones( goal.shape[:-1], bool )
+		loops = st.loops.max() if self.maxLoops is None else min( st.loops.max(), self.maxLoops )
+		for it in range( loops ):
+			if deadline is not None and time.perf_counter() > deadline:
+				self.truncated = True
+				break
+			active &= it < st.loops
+			if not active.any():
+				break
+			self.loops += 1
+
+			for k in range( st.linkAt.shape[1] ):
+				c = numpy.nonzero( st.linkAt[:, k] >= 0 )[0]
+				on = active[..., c]
+				if not on.any():
+					continue
+				at = st.linkAt[c, k]
+				j = st.path[c, at]
+				lp = aLoc[..., j, :]
+				la = aRot[..., j, :]
+
+				# the rotation of the link which turns the target to the goal.
+				inv = quaternion.conj( la )
+				e = quaternion.transform( inv, aLoc[..., st.target[c], :] - lp )
+				g = quaternion.transform( inv, goal[..., c, :] - lp )
+				e /= numpy.maximum( numpy.linalg.norm( e, axis = -1 ), 1e-12 )[..., None]
+				g /= numpy.maximum( numpy.linalg.norm( g, axis = -1 ), 1e-12 )[..., None]
+				axis = numpy.cross( e, g )
+				n = numpy.linalg.norm( axis, axis = -1 )
+				theta = numpy.arccos( numpy.clip( numpy.sum( e * g, axis = -1 ), -1.0, 1.0 ) )
+				theta = numpy.where( n > 1e-8, numpy.minimum( theta, st.limit[c] ), 0.0 )
+				delta = _axisAngle( axis / numpy.maximum( n, 1e-12 )[..., None], theta )
+
+				r = quaternion.mul( rRot[..., j, :], delta )
+				limited = st.limited[c, k]
+				if limited.any():
+					r[..., limited, :] = clampEuler( r[..., limited, :], st.lower[c[limited], k], st.upper[c[limited], k] )
+				r = numpy.where( on[..., None], r, rRot[..., j, :] )
+				rRot[..., j, :] = r
+
+				p = parents[j]
+				newA = quaternion.mul( numpy.where( (p >= 0)[:, None], aRot[..., p, :], quaternion.identities( 1 ) ), r )
+				dW = quaternion.mul( newA, inv )
+				aRot[..., j, :] = newA
+
+				# the bones below the link move rigidly.
+				ci, pi = numpy.nonzero( (numpy.arange( st.path.shape[1] ) > at[:, None]) & st.valid[c] )
+				b = st.path[c[ci], pi]
+				aLoc[..., b, :] = lp[..., ci, :] + quaternion.transform( dW[..., ci, :], aLoc[..., b, :] - lp[..., ci, :] )
+				aRot[..., b, :] = quaternion.mul( dW[..., ci, :], aRot[..., b, :] )
+
+			d = aLoc[..., st.target, :] - goal
+			active &= numpy.sum( d * d, axis = -1 ) > st.tol * st.tol
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import os
+import sys
+import struct
+import sqlite3
+import multiprocessing
+import numpy
+import pmx
+import vmd
+
+
+schema = """
+	CREATE TABLE IF NOT EXISTS files (
+		path      TEXT PRIMARY KEY,
+		kind      TEXT NOT NULL, -- "pmx" or "vmd"
+		mtime     REAL NOT NULL,
+		size      INTEGER NOT NULL,
+		valid     INTEGER NOT NULL,
+		verts     INTEGER,
+		faces     INTEGER,
+		materials INTEGER,
+		bones     INTEGER,
+		morphs    INTEGER,
+		boneKeys  INTEGER,
+		skeyKeys  INTEGER,
+		frameBgn  INTEGER,
+		frameEnd  INTEGER
+	);
+	CREATE TABLE IF NOT EXISTS names (
+		path TEXT NOT NULL REFERENCES files( path ) ON DELETE CASCADE,
+		kind TEXT NOT NULL, -- "bone" or "skey"
+		name TEXT NOT NULL,
+		PRIMARY KEY (path, kind, name)
+	);
+	CREATE INDEX IF NOT EXISTS namesByName ON names( kind, name );
+"""
+
+columns = [
+	"verts", "faces", "materials", "bones", "morphs",
+	"boneKeys", "skeyKeys", "frameBgn", "frameEnd",
+]
+
+
+def _scan( args ):
+	# metadata of a file by partial parsing: pmx sections other than the
+	# bones and the morphs are only skipped over, and vmd keys are read from
+	# the packed records without being parsed.
+	path, kind = args
+	meta = dict.fromkeys( columns )
+	names = []
+	try:
+		with open( path, "rb" ) as f:
+			if kind == "pmx":
+				model = pmx.Loader()
+				model.load( f, lazy = True )
+				for name in [ "verts", "faces", "materials", "bones", "morphs" ]:
+					meta[name] = model.count( name )
+				names += [ ("bone", k) for k in model.boneMap ]
+				names += [ ("skey", k) for k in model.skeyMap ]
+			else:
+				motion = vmd.Loader()
+				bones, skeys = motion.scan( f )
+				frames = numpy.concatenate( [ bones["frame"], skeys["frame"] ] )
+				meta["boneKeys"] = len( bones )
+				meta["skeyKeys"] = len( skeys )
+				if len( frames ) > 0:
+					meta["frameBgn"] = int( frames.min() )
+					meta["frameEnd"] = int( frames.max() )
+				names += [ ("bone", k) for k in motion.boneMap ]
+				names += [ ("skey", k) for k in motion.skeyMap ]
+	except (OSError, ValueError, IndexError, struct.error, UnicodeDecodeError):
+		return path, None, []
+	return path, meta, names
+
+
+# SQLite index of the models and the motions under directories.  files are
+# parsed by a pool of processes and again only when their mtime or size
+# changed.  the bone and morph names are indexed, so the compatibility of
+# models and motions is queried without opening the files.
+class Library( object ):
+
+	kinds = { ".pmx": "pmx", ".vmd": "vmd" }
+
+	def __init__( self, path ):
+		self.db = sqlite3.connect( path )
+		self.db.execute( "PRAGMA foreign_keys = ON" )
+		self.db.executescript( schema )
+
+	def close( self ):
+		self.db.close()
+
+	def update( self, root, processes = None ):
+		root = os.path.abspath( root )
+		known = {
+			path: (mtime, size) for (path, mtime, size) in
+			self.db.execute( "SELECT path, mtime, size FROM files" )
+			if path.startswith( os.path.join( root, "" ) )
+		}
+
+		stats = {}
+		for (base, _, files) in os.walk( root ):
+			for name in files:
+				kind = self.kinds.get( os.path.splitext( name )[1].lower() )
+				if kind is None:
+					continue
+				path = os.path.join( base, name )
+				try:
+					st = os.stat( path )
+				except OSError:
+					continue
+				stats[path] = (kind, st.st_mtime, st.st_size)
+
+		jobs = [
+			(path, kind) for (path, (kind, mtime, size)) in stats.items()
+			if known.get( path ) != (mtime, size)
+		]
+		with self.db:
+			self.db.executemany( "DELETE FROM files WHERE path = ?", [
+				(path,) for path in known if path not in stats
+			] )
+			if len( jobs ) == 0:
+				return
+			with multiprocessing.Pool( processes ) as pool:
+				for (path, meta, names) in pool.imap_unordered( _scan, jobs, chunksize = 4 ):
+					kind, mtime, size = stats[path]
+					self.db.execute( "DELETE FROM files WHERE path = ?", (path,) )
+					self.db.execute(
+						"INSERT INTO files VALUES (%s)" % ", ".join( [ "?" ] * (5 + len( columns )) ),
+						[ path, kind, mtime, size, meta is not None ] +
+						[ None if meta is None else meta[k] for k in columns ],
+					)
+					self.db.executemany( "INSERT OR IGNORE INTO names VALUES (?, ?, ?)", [
+						(path, k, name) for (k, name) in names
+					] )
+
+	def info( self, path ):
+		row = self.db.execute(
+			"SELECT kind, %s FROM files WHERE path = ?" % ", ".join( columns ),
+			(os.path.abspath( path ),),
+		).fetchone()
+		return None if row is None else dict( zip( [ "kind" ] + columns, row ) )
+
+	def motionsFor( self, model, ratio = 0.9 ):
+		# motions with tracks for at least ratio of the bones of the model,
+		# as (path, ratio) in the descending order of the ratio.
+		return self._bound( model, "pmx", "vmd", ratio )
+
+	def modelsFor( self, motion, ratio = 0.9 ):
+		# models with at least ratio of the bones the motion has tracks for.
+		return self._bound( motion, "vmd", "pmx", ratio )
+
+	def _bound( self, path, srcKind, dstKind, ratio ):
+		path = os.path.abspath( path )
+		N, = self.db.execute( """
+			SELECT COUNT(*) FROM names JOIN files USING (path)
+			WHERE path = ? AND files.kind = ? AND names.kind = 'bone'
+		""", (path, srcKind) ).fetchone()
+		if N == 0:
+			return []
+		rows = self.db.execute( """
+			SELECT dst.path, COUNT(*) FROM names AS src
+			JOIN names AS dst ON dst.kind = 'bone' AND dst.name = src.name
+			JOIN files ON files.path = dst.path
+			WHERE src.path = ? AND src.kind = 'bone' AND files.kind = ?
+			GROUP BY dst.path HAVING COUNT(*) >= ?
+			ORDER BY COUNT(*) DESC, dst.path
+		""", (path, dstKind, ratio * N) )
+		return [ (p, n / N) for (p, n) in rows ]
+
+
+def main():
+	if len( sys.argv ) < 3:
+		print( "usage: %s index.sqlite dir..." % sys.argv[0] )
+		sys.exit( 1 )
+
+	library = Library( sys.argv[1] )
+	for root in sys.argv[2:]:
+		library.update( root )
+	library.close()
+
+
+if __name__ == "__main__":
+	main()
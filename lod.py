@@ -0,0 +1,176 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import math
+import numpy
+
+
+def _normals( pos, faces ):
+	n = numpy.cross( pos[faces[:, 1]] - pos[faces[:, 0]], pos[faces[:, 2]] - pos[faces[:, 0]] )
+	return n, numpy.sqrt( numpy.sum( n * n, axis = -1 ) )
+
+def _planes( n, p, w ):
+	# weighted quadrics (..., 4, 4) of the planes of the unit normals n
+	# through p.
+	plane = numpy.concatenate( [ n, -numpy.sum( n * p, axis = -1, keepdims = True ) ], axis = -1 )
+	return w[:, None, None] * plane[:, :, None] * plane[:, None, :]
+
+def quadrics( pos, faces, border = 1e3 ):
+	# error quadrics of the vertices: the planes of the triangles around them
+	# weighted by area, and the planes perpendicular to the open edges
+	# weighted by border so that the outlines are kept.
+	Q = numpy.zeros( (len( pos ), 4, 4), numpy.float64 )
+	if len( faces ) == 0:
+		return Q
+	n, l = _normals( pos, faces )
+	n = n / numpy.maximum( l, 1e-12 )[:, None]
+	q = _planes( n, pos[faces[:, 0]], l * 0.5 )
+	for k in range( 3 ):
+		numpy.add.at( Q, faces[:, k], q )
+
+	# edges used once (in either direction) are open.
+	edges = numpy.stack( [ faces, numpy.roll( faces, -1, axis = 1 ) ], axis = -1 ).reshape( (-1, 2) )
+	keys = numpy.sort( edges, axis = 1 )
+	_, inv, counts = numpy.unique( keys, axis = 0, return_inverse = True, return_counts = True )
+	open_ = counts[inv.ravel()] == 1
+	a = edges[open_, 0]
+	b = edges[open_, 1]
+	d = pos[b] - pos[a]
+	m = numpy.cross( d, numpy.repeat( n, 3, axis = 0 )[open_] )
+	lm = numpy.sqrt( numpy.sum( m * m, axis = -1 ) )
+	q = _planes( m / numpy.maximum( lm, 1e-12 )[:, None], pos[a], border * numpy.sum( d * d, axis = -1 ) )
+	numpy.add.at( Q, a, q )
+	numpy.add.at( Q, b, q )
+	return Q
+
+
+def _around( faces, N ):
+	# CSR of the triangles around each vertex.
+	order = numpy.argsort( faces.ravel(), kind = "stable" )
+	offsets = numpy.searchsorted( faces.ravel()[order], numpy.arange( N + 1 ) )
+	return order // 3, offsets
+
+def _ring( x, faces ):
+	# the minimum of x over each vertex and the vertices sharing a triangle
+	# with it.
+	y = x.copy()
+	numpy.minimum.at( y, faces.ravel(), numpy.repeat( x[faces].min( axis = 1 ), 3 ) )
+	return y
+
+def _collapses( pos, faces, normals, tris, offsets, u, v ):
+	# whether replacing u by v turns a triangle around u over (its normal
+	# by more than about 78 degrees), and the number of triangles it removes,
+	# for all the pairs at once.  the normal of (u, b, c) moves by
+	# (v - u) x (b - c).
+	n = offsets[u + 1] - offsets[u]
+	e = numpy.repeat( numpy.arange( len( u ) ), n )
+	t = tris[numpy.arange( len( e ) ) - numpy.repeat( numpy.cumsum( n ) - n - offsets[u], n )]
+	f = faces[t]
+	shared = numpy.any( f == v[e, None], axis = 1 )
+	r = numpy.arange( len( t ) )
+	k = numpy.argmax( f == u[e, None], axis = 1 )
+	n0 = normals[t]
+	n1 = n0 + numpy.cross( pos[v[e]] - pos[u[e]], pos[f[r, (k + 1) % 3]] - pos[f[r, (k + 2) % 3]] )
+	d = numpy.einsum( "ij,ij->i", n0, n1 )
+	bad = ~shared & (d <= 0.2 * numpy.sqrt( numpy.einsum( "ij,ij->i", n0, n0 ) * numpy.einsum( "ij,ij->i", n1, n1 ) ))
+	return (
+		numpy.bincount( e[bad], minlength = len( u ) ) > 0,
+		numpy.bincount( e[shared], minlength = len( u ) ),
+	)
+
+def simplify( pos, faces, targets, locked ):
+	# quadric error half-edge collapses (Garland and Heckbert) of the
+	# (triangles, 3) indices into pos, which are kept: a vertex is replaced
+	# by a neighbour, never moved, so the simplified meshes index the same
+	# vertices.  locked vertices are never removed.  collapses flipping a
+	# triangle are rejected.  the faces are returned for each of the
+	# decreasing triangle counts of targets, fewer if the mesh cannot be
+	# simplified further.
+	# the collapses are batched: every round, each vertex takes its cheapest
+	# valid collapse, and a set of them more than two edges apart, the
+	# cheapest first, is applied at once.  their triangles are disjoint, so
+	# they are independent of each other.
+	# on the vertices used only, as the faces may be a part of a mesh.
+	used, faces = numpy.unique( faces, return_inverse = True )
+	faces = faces.reshape( (-1, 3) )
+	pos = pos[used]
+	locked = locked[used]
+	N = len( pos )
+	Q = quadrics( pos, faces )
+	home = numpy.concatenate( [ pos, numpy.ones( (N, 1) ) ], axis = 1 )
+	levels = []
+	targets = list( targets )
+	while targets:
+		if len( faces ) <= targets[0]:
+			levels.append( used[faces] )
+			targets.pop( 0 )
+			continue
+
+		keys = numpy.concatenate( [ faces[:, i] * N + faces[:, j] for i in range( 3 ) for j in range( 3 ) if i != j ] )
+		keys.sort()
+		keys = keys[numpy.diff( keys, prepend = -1 ) != 0]
+		u = keys // N
+		v = keys % N
+		u, v = u[~locked[u]], v[~locked[u]]
+		costs = numpy.einsum( "ei,eij,ej->e", home[v], Q[u] + Q[v], home[v] )
+		tris, offsets = _around( faces, N )
+		normals, _ = _normals( pos, faces )
+
+		# the cheapest collapse of each vertex which does not flip, all the
+		# candidates tested at once.
+		bad, shared = _collapses( pos, faces, normals, tris, offsets, u, v )
+		idx = numpy.flatnonzero( ~bad )
+		idx = idx[numpy.lexsort( (costs[idx], u[idx]) )]
+		idx = idx[numpy.diff( u[idx], prepend = -1 ) != 0]
+		best = numpy.full( (N,), -1, numpy.int64 )
+		best[u[idx]] = idx
+		removed = numpy.zeros( (N,), numpy.int64 )
+		removed[u[idx]] = shared[idx]
+
+		# the vertices cheapest within two edges among those not within two
+		# edges of the chosen ones, by (cost, index), until none are left.
+		cost = numpy.full( (N,), numpy.inf )
+		cost[best >= 0] = costs[best[best >= 0]]
+		rank = numpy.empty( (N,), numpy.int64 )
+		rank[numpy.argsort( cost, kind = "stable" )] = numpy.arange( N )
+		chosen = numpy.zeros( (N,), bool )
+		open_ = best >= 0
+		while open_.any():
+			r = numpy.where( open_, rank, N )
+			chosen |= open_ & (_ring( _ring( r, faces ), faces ) == r)
+			open_ &= _ring( _ring( (~chosen).astype( numpy.int8 ), faces ), faces ) > 0
+		src = numpy.nonzero( chosen )[0]
+		if len( src ) == 0:
+			break
+
+		# no more than the target needs, the cheapest first.
+		src = src[numpy.argsort( cost[src], kind = "stable" )]
+		src = src[numpy.cumsum( removed[src] ) - removed[src] < len( faces ) - targets[0]]
+		dst = v[best[src]]
+		remap = numpy.arange( N )
+		remap[src] = dst
+		Q[dst] += Q[src]
+		faces = remap[faces]
+		faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+	return levels
+
+
+def locks( pos, faces, materials ):
+	# vertices sharing the position of another one (UV seams and hard edges)
+	# and vertices used by more than one material.
+	N = len( pos )
+	_, inv, counts = numpy.unique( pos, axis = 0, return_inverse = True, return_counts = True )
+	locked = counts[inv.ravel()] > 1
+	owner = numpy.full( (N,), -1, numpy.int64 )
+	for (i, m) in enumerate( materials ):
+		idx = numpy.unique( faces[m.bgn // 3 : m.end // 3] )
+		locked[idx[(owner[idx] >= 0) & (owner[idx] != i)]] = True
+		owner[idx] = i
+	return locked
+
+
+def select( size, levels, full = 512.0 ):
+	# the level for a model of the projected size (in pixels): 0 down to
+	# full, then one more for each halving.
+	if size >= full:
+		return 0
+	return min( int( math.log2( full / max( size, 1e-6 ) ) ) + 1, levels )
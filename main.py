@@ -4,15 +4,22 @@
 
 from pprint import pprint
 import math
-import bisect
 import time
-import io
+import os
 import numpy
 from OpenGL.GL import *
 from PIL import Image
 import matrix3d
-import quaternion
+import skinning
+import morphing
+import blend
+import posecache
+import ik
+import physics
+import lod
+import bounds
 import glutils
+import cache
 import pmx
 import vmd
 
@@ -72,17 +79,40 @@ class Renderer( object ):
 		}
 	"""
 
+	# model to clip space scale of viewMatrix()
+	scale = 0.09
+
+	# faces may keep the on-disk index width (see pmx.Loader.load)
+	indexTypes = {
+		"B": GL_UNSIGNED_BYTE,
+		"H": GL_UNSIGNED_SHORT,
+		"I": GL_UNSIGNED_INT,
+	}
+
 	def __init__( self, model, motion ):
 		self.model  = model
 		self.motion = motion
 		self.bones = numpy.recarray( (model.bones.shape[0],), dtype = [
-			("rLoc", numpy.float32, (3,)),
-			("rRot", numpy.float32, (4,)),
 			("aLoc", numpy.float32, (3,)),
 			("aRot", numpy.float32, (4,)),
 			("aMat", numpy.float32, (4, 4)),
 		] )
+		# the motion is the first layer; others may be added or crossfaded.
+		self.blend = blend.Blend( model )
+		self.blend.add( motion )
+		self.skeleton = self.blend.skeleton
+		self.ik = ik.IK( model, self.skeleton, budget = 0.004 )
+		self.poses = posecache.PoseCache()
+		self.physics = physics.Physics( model, self.skeleton )
+		self.bounds = bounds.Bounds( model )
+		self.visible = numpy.ones( (len( model.materials ),), bool )
+		self.morphs = numpy.zeros( (model.morphs.shape[0],), numpy.float32 )
+		self.morphing = morphing.Morphing( model )
+		self.skinning = skinning.Skinning( model )
 		self.frame = 0
+		verts = model.vertices()[0].vert
+		self.radius = numpy.sqrt( numpy.max( numpy.sum( (verts - verts.mean( axis = 0 )) ** 2, axis = -1 ), initial = 0.0 ) )
+		self.lodRanges = getattr( model, "lodRanges", numpy.zeros( (0, 0, 2), numpy.int64 ) )
 
 		for (i, tex) in enumerate( model.texs ):
 			glActiveTexture( GL_TEXTURE0 + i )
@@ -95,9 +125,11 @@ class Renderer( object ):
 
 		self.shader = glutils.Shader( self.vertSrc, self.fragSrc )
 		self.shader.use()
-		self.shader.attrib( b"aP",  model.verts.vert )
-		self.shader.attrib( b"aN",  model.verts.norm )
-		self.shader.attrib( b"aUv", model.verts.uv   )
+		# skinned in place by updateFrame.
+		self.updateFrame( 0 )
+		self.shader.attrib( b"aP",  self.skinning.verts )
+		self.shader.attrib( b"aN",  self.skinning.norms )
+		self.shader.attrib( b"aUv", self.morphing.uvs  )
 
 		glDepthFunc( GL_LEQUAL )
 		glEnable( GL_DEPTH_TEST )
@@ -112,12 +144,9 @@ class Renderer( object ):
 		)
 		glEnable( GL_BLEND )
 
-	def render( self ):
+	def viewMatrix( self ):
 		arg = (time.time() * (2.0 / math.pi)) % (2.0 * math.pi)
-
-		# XXX: sort transparent polygon
-		glClear( GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT )
-		self.shader.uniform( b"uM",
+		return (
 			numpy.matrix( [
 				[1.0, 0.0, 0.0, 0.0],
 				[0.0, 1.0, 0.0, 0.0],
@@ -127,10 +156,20 @@ class Renderer( object ):
 			matrix3d.rotate( 0, math.pi / -24.0 ) *
 			matrix3d.rotate( 1, arg ) *
 			matrix3d.translate( [0.0, -0.9, 0.0] ) *
-			matrix3d.scale( 0.09 )
+			matrix3d.scale( self.scale )
 		)
 
-		for m in self.model.materials:
+	def render( self ):
+		# the level of detail by the projected diameter in pixels.
+		level = lod.select( self.radius * self.scale * glGetIntegerv( GL_VIEWPORT )[3], len( self.lodRanges ) )
+
+		# XXX: sort transparent polygon
+		glClear( GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT )
+		self.shader.uniform( b"uM", self.view )
+
+		for (i, m) in enumerate( self.model.materials ):
+			if not self.visible[i]:
+				continue
 			if m.name.find( "体" ) >= 0 or m.name.find( "skin" ) >= 0:
 				self.shader.uniform( b"uType", 1 )
 			elif m.name.find( "顔" ) >= 0 or m.name.find( "face" ) >= 0:
@@ -141,48 +180,34 @@ class Renderer( object ):
 				self.shader.uniform( b"uType", 0 )
 			self.shader.uniform( b"uTex", m.tex )
 
-			glDrawElementsui( GL_TRIANGLES, self.model.faces[m.bgn // 3 : m.end // 3] )
+			if level == 0:
+				faces = self.model.faces[m.bgn // 3 : m.end // 3]
+			else:
+				bgn, end = self.lodRanges[level - 1, i]
+				faces = self.model.lodFaces[bgn // 3 : end // 3]
+			glDrawElements( GL_TRIANGLES, faces.size, self.indexTypes[faces.dtype.char], faces )
 	
 	def updateFrame( self, frame ):
-		bgn = bisect.bisect_left ( self.motion.bones.frame, self.frame )
-		end = bisect.bisect_right( self.motion.bones.frame, frame )
-		for i in range( bgn, end ):
-			boneKey = self.motion.bones[i]
-			self.bones[boneKey.bone].rRot = boneKey.rot
-			self.bones[boneKey.bone].rLoc = boneKey.loc
-		
-		timeBgn = time.time()
-		#for i in range( len( self.bones ) ):
-		#	parent = self.model.bones[i].parent
-		#	if parent < 0:
-		#		self.bones[i].aRot = self.bones[i].rRot
-		#		self.bones[i].aLoc = self.bones[i].rLoc
-		#	else:
-		#		self.bones[i].aRot = quaternion.mul(
-		#			self.bones[i].rRot,
-		#			self.bones[parent].aRot
-		#		)
-		#		self.bones[i].aLoc = quaternion.transform(
-		#			self.bones[i].aRot,
-		#			self.bones[i].rLoc,
-		#		) + self.bones[parent].aLoc
-		parents = self.model.bones.parent
-		aRots = self.bones.aRot
-		aLocs = self.bones.aLoc
-		rRots = self.bones.rRot
-		rLocs = self.bones.rLoc
-		for i in range( len( self.bones ) ):
-			parent = parents[i]
-			if parent < 0:
-				aRots[i] = rRots[i]
-				aLocs[i] = rLocs[i]
-			else:
-				aRots[i] = quaternion.mul( rRots[i], aRots[parent] )
-				aLocs[i] = quaternion.transform( aRots[i], rLocs[i] ) + aLocs[parent]
-		timeEnd = time.time()
-
-		# too slow...
-		print( timeEnd - timeBgn )
+		self.poses.pose(
+			self.blend, self.skeleton, frame,
+			self.bones.aRot, self.bones.aLoc, self.bones.aMat, self.ik,
+		)
+		# the bodies are stepped forward in time, or reset on seeks.
+		if 0.0 < frame - self.frame < self.physics.fps:
+			self.physics.step( self.bones.aRot, self.bones.aLoc, (frame - self.frame) / self.physics.fps )
+		else:
+			self.physics.reset( self.bones.aRot, self.bones.aLoc )
+		self.skeleton.matrices( self.bones.aRot, self.bones.aLoc, self.bones.aMat )
+
+		# the view is fixed here for render(), and the materials out of it
+		# are not drawn; nothing is skinned if none is in.
+		self.view = self.viewMatrix()
+		lo, hi = self.bounds.update( self.bones.aMat )
+		self.visible = ~bounds.outside( bounds.frustum( self.view ), lo, hi )
+		if self.visible.any():
+			self.poses.morphs( self.blend, frame, self.morphs )
+			self.morphing.update( self.morphs )
+			self.skinning.update( self.bones.aMat, self.bones.aRot, self.morphing.verts )
 
 		self.frame = frame
 
@@ -243,19 +268,18 @@ class QtWindow( QtOpenGL.QGLWidget ):
 		self.renderer = Renderer( self.model, self.motion )
 	
 	def onTimer( self ):
-		self.renderer.updateFrame( int( (time.time() - self.timeBgn) * self.timeFps ) )
+		self.renderer.updateFrame( (time.time() - self.timeBgn) * self.timeFps )
 		self.updateGL()
 
 
 def main():
-	pmxLoader = pmx.Loader()
-	with io.open( "test.pmx", "rb" ) as f:
-		pmxLoader.load( f )
+	store = cache.Cache( os.path.expanduser( "~/.cache/mmd_test_junk" ) )
+	# (bulk, mapped, lazy, optimize, lods, compact) of pmx.Loader.load.
+	pmxLoader = store.load( pmx.Loader, "test.pmx", True, False, False, True, (0.5, 0.25, 0.125), True )
 	print( dir( pmxLoader ) )
+	print( "ACMR: %.3f -> %.3f" % pmxLoader.acmr )
 
-	vmdLoader = vmd.Loader()
-	with io.open( "test.vmd", "rb" ) as f:
-		vmdLoader.load( f, pmxLoader.boneMap, {} )
+	vmdLoader = store.load( vmd.Loader, "test.vmd" )
 	print( dir( vmdLoader ) )
 
 	if False:
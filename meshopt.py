@@ -0,0 +1,112 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import collections
+import numpy
+
+
+def acmr( faces, size = 32 ):
+	# average cache miss ratio of the (triangles, 3) indices: vertex shader
+	# runs per triangle with a FIFO post-transform cache of the size.
+	if len( faces ) == 0:
+		return 0.0
+	fifo = collections.deque()
+	cached = set()
+	misses = 0
+	for v in faces.ravel().tolist():
+		if v not in cached:
+			misses += 1
+			fifo.append( v )
+			cached.add( v )
+			if len( fifo ) > size:
+				cached.discard( fifo.popleft() )
+	return misses / len( faces )
+
+
+def _scores( size ):
+	# Forsyth's vertex scores by the position in the LRU cache (-1 if not
+	# cached) and by the number of remaining triangles.
+	pos = [ 0.0 ] + [
+		0.75 if i < 3 else (1.0 - (i - 3) / (size - 3)) ** 1.5
+		for i in range( size )
+	]
+	valence = [ 0.0 ] + [ 2.0 * n ** -0.5 for n in range( 1, 256 ) ]
+	return pos, valence
+
+def forsyth( faces, size = 32 ):
+	# the order of the triangles for vertex cache reuse by Tom Forsyth's
+	# "Linear-Speed Vertex Cache Optimisation": the next triangle is the best
+	# scored one using the cached vertices, or the best of all if none.
+	F = len( faces )
+	if F == 0:
+		return numpy.zeros( (0,), numpy.int64 )
+	verts, tris = numpy.unique( faces, return_inverse = True )
+	tris = tris.reshape( (F, 3) )
+	order = numpy.argsort( tris.ravel(), kind = "stable" )
+	offsets = numpy.searchsorted( tris.ravel()[order], numpy.arange( len( verts ) + 1 ) ).tolist()
+	adj = (order // 3).tolist()
+	tris = tris.tolist()
+
+	posScore, valenceScore = _scores( size )
+	remaining = numpy.diff( offsets ).tolist()
+	position = [ -1 ] * len( verts )
+	def score( v ):
+		n = remaining[v]
+		return 0.0 if n == 0 else posScore[position[v] + 1] + valenceScore[min( n, 255 )]
+
+	vScore = [ score( v ) for v in range( len( verts ) ) ]
+	tScore = numpy.array( [ vScore[a] + vScore[b] + vScore[c] for (a, b, c) in tris ] )
+	live = [ True ] * F
+	cache = []
+	dst = []
+	best = -1
+	for _ in range( F ):
+		if best < 0:
+			best = int( numpy.argmax( tScore ) )
+		dst.append( best )
+		live[best] = False
+		tScore[best] = -1.0
+		tri = tris[best]
+		for v in tri:
+			remaining[v] -= 1
+
+		cache = tri + [ v for v in cache if v not in tri ]
+		evicted = cache[size:]
+		del cache[size:]
+		for v in evicted:
+			position[v] = -1
+		for (i, v) in enumerate( cache ):
+			position[v] = i
+
+		best = -1
+		bestScore = -1.0
+		for v in cache + evicted:
+			vScore[v] = score( v )
+		for v in cache + evicted:
+			for t in adj[offsets[v] : offsets[v + 1]]:
+				if live[t]:
+					a, b, c = tris[t]
+					s = vScore[a] + vScore[b] + vScore[c]
+					tScore[t] = s
+					if s > bestScore and position[v] >= 0:
+						best, bestScore = t, s
+	return numpy.array( dst, numpy.int64 )
+
+
+def dedupe( keys, keep ):
+	# the first of the identical rows of keys for every row, except that rows
+	# of keep are neither merged nor merged into.
+	N = keys.shape[0]
+	rows = numpy.ascontiguousarray( keys ).view( numpy.dtype( (numpy.void, keys.dtype.itemsize * keys.shape[1]) ) ).ravel()
+	remap = numpy.arange( N )
+	free = numpy.nonzero( ~keep )[0]
+	_, first, inv = numpy.unique( rows[free], return_index = True, return_inverse = True )
+	remap[free] = free[first[inv.ravel()]]
+	return remap
+
+
+def fetchOrder( faces, N ):
+	# the vertices by their first use in faces, then the unused ones.
+	idx = faces.ravel()
+	first = numpy.full( (N,), len( idx ), numpy.int64 )
+	numpy.minimum.at( first, idx, numpy.arange( len( idx ) ) )
+	return numpy.argsort( first, kind = "stable" )
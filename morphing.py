@@ -0,0 +1,66 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+
+
+def _rows( offsets, morphs ):
+	# indices of the records of the morphs in a table of pmx.Loader._csr.
+	bgn = offsets[morphs]
+	cnt = offsets[morphs + 1] - bgn
+	if cnt.sum() == 0:
+		return numpy.zeros( (0,), numpy.int64 )
+	return numpy.repeat( bgn - numpy.cumsum( cnt ) + cnt, cnt ) + numpy.arange( cnt.sum() )
+
+
+# applies the vertex and UV morphs of a pmx.Loader by morph weights (see
+# animation.Animation.evaluateMorphs).  the sum of the offsets is a sparse
+# product of the morph tables and the weights, and only the rows of nonzero
+# weights are visited.  the outputs (verts, uvs) are allocated once, and only
+# the vertices moved by the last update are restored, so an update costs the
+# touched vertices rather than the whole mesh.
+class Morphing( object ):
+
+	def __init__( self, model ):
+		self.model = model
+		verts, _ = model.vertices()
+		self.restVerts = numpy.array( verts.vert, dtype = numpy.float32 )
+		self.restUvs = numpy.array( verts.uv, dtype = numpy.float32 )
+		self.verts = self.restVerts.copy()
+		self.uvs = self.restUvs.copy()
+		self._verts = numpy.zeros( (0,), numpy.int64 )
+		self._uvs = numpy.zeros( (0,), numpy.int64 )
+
+	def update( self, weights ):
+		weights = self._expand( weights )
+		morphs = numpy.nonzero( weights )[0]
+		self._verts = self._apply(
+			self.verts, self.restVerts, self._verts,
+			self.model.vertMorphs, self.model.vertMorphOffsets, weights, morphs, 3,
+		)
+		self._uvs = self._apply(
+			self.uvs, self.restUvs, self._uvs,
+			self.model.uvMorphs, self.model.uvMorphOffsets, weights, morphs, 2,
+		)
+
+	def _expand( self, weights ):
+		# group morphs add their weight to the members (groups do not nest).
+		offsets = self.model.groupMorphOffsets
+		groups = numpy.nonzero( weights[:len( offsets ) - 1] * numpy.diff( offsets ) )[0]
+		if len( groups ) == 0:
+			return weights
+		rows = _rows( offsets, groups )
+		table = self.model.groupMorphs
+		weights = numpy.array( weights, dtype = numpy.float32 )
+		owner = numpy.repeat( groups, offsets[groups + 1] - offsets[groups] )
+		numpy.add.at( weights, table.morph[rows], table.weight[rows] * weights[owner] )
+		return weights
+
+	def _apply( self, dst, rest, prev, table, offsets, weights, morphs, n ):
+		dst[prev] = rest[prev]
+		rows = _rows( offsets, morphs )
+		if len( rows ) == 0:
+			return rows
+		owner = numpy.repeat( morphs, offsets[morphs + 1] - offsets[morphs] )
+		verts = table.vert[rows]
+		numpy.add.at( dst, verts, table.offset[rows, :n] * weights[owner, None] )
+		return verts
@@ -0,0 +1,192 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+import quaternion
+
+
+def _norm( x ):
+	return numpy.sqrt( numpy.sum( x * x, axis = -1 ) )
+
+def _arc( u, v ):
+	# the shortest rotation from the direction u to v, or the identity if
+	# either is degenerate.
+	u = u / numpy.maximum( _norm( u ), 1e-6 )[..., None]
+	v = v / numpy.maximum( _norm( v ), 1e-6 )[..., None]
+	q = numpy.empty( u.shape[:-1] + (4,), numpy.float32 )
+	q[..., 0] = 1.0 + numpy.sum( u * v, axis = -1 )
+	q[..., 1:] = numpy.cross( u, v )
+	n = numpy.sqrt( quaternion.norm2( q ) )
+	q[n < 1e-6] = [ 1.0, 0.0, 0.0, 0.0 ]
+	return q / numpy.maximum( n, 1e-6 )[..., None]
+
+
+# secondary motion of the rigid bodies and the joints of a pmx.Loader (see
+# pmx.Loader.rigids and joints), run after forward kinematics (and IK) on the
+# absolute pose.  the bodies are particles at their centers: bodies following
+# their bones (mode 0) are moved by the pose, the others are integrated by
+# Verlet steps with gravity and their linear damping, and the joints pull
+# them back by position based projections.
+#
+# a joint keeps the offset between its bodies within the rotation limit (the
+# largest angle of its range) of the offset the pose alone would give, and
+# its length within the translation limit of it; the springs blend the offset
+# towards the posed one.  collisions are not computed.  the bones of the
+# dynamic bodies are then rotated about their origins towards the bodies, in
+# the order of the hierarchy.
+#
+# the state persists between steps, so frames must be stepped in order; a
+# step advances dt seconds (1 / fps by default) by substeps fixed steps of
+# iterations projections each, and is deterministic.  poses may have leading
+# axes, e.g. (instances, bones, 4), which are stepped at once.
+class Physics( object ):
+
+	def __init__( self, model, skel, fps = 30.0, substeps = 4, iterations = 4, gravity = (0.0, -98.0, 0.0) ):
+		self.skeleton = skel
+		self.fps = fps
+		self.substeps = substeps
+		self.iterations = iterations
+		self.gravity = numpy.array( gravity, numpy.float32 )
+
+		rigids = model.rigids
+		B = rigids.shape[0]
+		self.bone = numpy.array( rigids.bone, numpy.int32 )
+		self.pos = numpy.array( rigids.pos, numpy.float32 )
+		self.dynamic = (rigids.mode != 0) & (rigids.mass > 0.0)
+		self.damping = numpy.clip( 1.0 - rigids.linDamping, 0.0, 1.0 ).astype( numpy.float32 )
+		bound = self.bone >= 0
+		self.offset = self.pos.copy()
+		self.offset[bound] -= skel.pos[self.bone[bound]]
+		w = numpy.where( self.dynamic, 1.0 / numpy.maximum( rigids.mass, 1e-6 ), 0.0 )
+
+		# joints between two bodies of which at least one is dynamic.
+		joints = model.joints
+		a = joints.rigids[:, 0]
+		b = joints.rigids[:, 1]
+		valid = (a >= 0) & (a < B) & (b >= 0) & (b < B) & (a != b)
+		valid[valid] = self.dynamic[a[valid]] | self.dynamic[b[valid]]
+		joints = joints[valid]
+		self.a = a[valid].astype( numpy.int32 )
+		self.b = b[valid].astype( numpy.int32 )
+		self.slack = _norm( numpy.maximum( -joints.posLower, joints.posUpper ).clip( 0.0 ) ).astype( numpy.float32 )
+		cone = numpy.maximum( -joints.rotLower, joints.rotUpper ).clip( 0.0, numpy.pi ).max( axis = -1 )
+		self.cosCone = numpy.cos( cone ).astype( numpy.float32 )
+		self.sinCone = numpy.sin( cone ).astype( numpy.float32 )
+		self.stiffness = (joints.posSpring.mean( axis = -1 ) + joints.rotSpring.mean( axis = -1 )).astype( numpy.float32 )
+
+		# the joints are split into sets sharing no body, each projected at
+		# once; the corrections are shared by the inverse masses of the two
+		# bodies, which is a (bodies, joints) matrix per set.
+		wa = w[self.a]
+		wb = w[self.b]
+		colors = []
+		for i in range( self.a.shape[0] ):
+			for c in colors:
+				if self.a[i] not in c[1] and self.b[i] not in c[1]:
+					break
+			else:
+				c = ([], set())
+				colors.append( c )
+			c[0].append( i )
+			c[1].update( (int( self.a[i] ), int( self.b[i] )) )
+		self.sets = []
+		for (js, _) in colors:
+			js = numpy.array( js, numpy.int32 )
+			scatter = numpy.zeros( (B, len( js )), numpy.float32 )
+			scatter[self.b[js], numpy.arange( len( js ) )] = wb[js] / (wa[js] + wb[js])
+			scatter[self.a[js], numpy.arange( len( js ) )] = -wa[js] / (wa[js] + wb[js])
+			self.sets.append( (js, scatter) )
+
+		# the bones driven by the dynamic bodies (the first of each bone),
+		# by the levels of the skeleton from the first one driven.
+		driven = {}
+		for i in numpy.nonzero( self.dynamic & bound )[0]:
+			driven.setdefault( int( self.bone[i] ), int( i ) )
+		self.levels = []
+		for (idx, parent) in skel.levels:
+			sel = numpy.array( [ k for (k, j) in enumerate( idx ) if int( j ) in driven ], numpy.int32 )
+			if len( sel ) == 0 and len( self.levels ) == 0:
+				continue
+			body = numpy.array( [ driven[int( idx[k] )] for k in sel ], numpy.int32 )
+			self.levels.append( (idx, parent, sel, body) )
+
+		self.x = None
+
+	def reset( self, aRot, aLoc ):
+		# puts the bodies at rest at the pose.
+		kin = self._kinematic( aRot, aLoc )
+		self.x = kin.copy()
+		self.xPrev = kin.copy()
+		self.kin = kin
+
+	def step( self, aRot, aLoc, dt = None ):
+		# advances the bodies to the pose and rotates the driven bones of it
+		# in place.
+		kin = self._kinematic( aRot, aLoc )
+		if self.x is None or self.x.shape != kin.shape:
+			self.reset( aRot, aLoc )
+		h = numpy.float32( (1.0 / self.fps if dt is None else dt) / self.substeps )
+		damping = (self.damping ** h)[:, None]
+		spring = numpy.minimum( self.stiffness * h * h, 1.0 )[:, None] / self.iterations
+		dynamic = self.dynamic[:, None]
+
+		x = self.x
+		xPrev = self.xPrev
+		for s in range( self.substeps ):
+			k = self.kin + (kin - self.kin) * numpy.float32( (s + 1) / self.substeps )
+			x, xPrev = numpy.where( dynamic, x + (x - xPrev) * damping + self.gravity * (h * h), k ), x
+			for _ in range( self.iterations ):
+				for (js, scatter) in self.sets:
+					x = x + numpy.matmul( scatter, self._correction( js, x, k, spring[js] ) )
+		self.x = x
+		self.xPrev = xPrev
+		self.kin = kin
+
+		self._drive( aRot, aLoc )
+
+	def _kinematic( self, aRot, aLoc ):
+		# the centers of the bodies moved with their bones.
+		bone = numpy.maximum( self.bone, 0 )
+		kin = aLoc[..., bone, :] + quaternion.transform( aRot[..., bone, :], self.offset )
+		return numpy.where( (self.bone >= 0)[:, None], kin, self.pos ).astype( numpy.float32 )
+
+	def _correction( self, js, x, k, spring ):
+		a = self.a[js]
+		b = self.b[js]
+		rel = x[..., b, :] - x[..., a, :]
+		pose = k[..., b, :] - k[..., a, :]
+		l = _norm( rel )
+		l0 = _norm( pose )
+		u = rel / numpy.maximum( l, 1e-6 )[..., None]
+		v = pose / numpy.maximum( l0, 1e-6 )[..., None]
+
+		# the direction clamped into the cone around the posed one.
+		c = numpy.sum( u * v, axis = -1 )
+		perp = u - v * c[..., None]
+		n = _norm( perp )
+		out = (c < self.cosCone[js]) & (n > 1e-6)
+		clamped = v * self.cosCone[js, None] + perp * (self.sinCone[js] / numpy.maximum( n, 1e-6 ))[..., None]
+		u = numpy.where( out[..., None], clamped, u )
+
+		target = u * numpy.clip( l, l0 - self.slack[js], l0 + self.slack[js] )[..., None]
+		target += (pose - target) * spring
+		return target - rel
+
+	def _drive( self, aRot, aLoc ):
+		# the levels are recomputed from the relative pose, so the bones below
+		# a driven one follow it.
+		if len( self.levels ) == 0:
+			return
+		rRot = numpy.empty_like( aRot )
+		rLoc = numpy.empty_like( aLoc )
+		self.skeleton.backward( aRot, aLoc, rRot, rLoc )
+		offsets = self.skeleton.offsets
+		for (idx, parent, sel, body) in self.levels:
+			if parent[0] >= 0:
+				aRot[..., idx, :] = quaternion.mul( aRot[..., parent, :], rRot[..., idx, :] )
+				aLoc[..., idx, :] = quaternion.transform( aRot[..., parent, :], offsets[idx] + rLoc[..., idx, :] ) + aLoc[..., parent, :]
+			if len( sel ) > 0:
+				bone = idx[sel]
+				rot = aRot[..., bone, :]
+				posed = quaternion.transform( rot, self.offset[body] )
+				moved = self.x[..., body, :] - aLoc[..., bone, :]
+				aRot[..., bone, :] = quaternion.normalize( quaternion.mul( _arc( posed, moved ), rot ) )
@@ -1,8 +1,14 @@
 # by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
 
+import os
+import re
+import mmap
 import numpy
 import struct
 import unicodedata
+import meshopt
+import lod
+import quantize
 
 
 def argTopoSort( parents ):
@@ -36,26 +42,267 @@ class Material( object ):
 
 class Loader( object ):
 
-	def load( self, file ):
-		self._file = file
+	# bump when the parsed result changes (see cache.Cache)
+	version = 6
+
+	# (section, attributes, loader, skipper) in the file order
+	sections = [
+		("verts",     ["verts", "weights"],  "_loadVerts",     "_skipVerts"),
+		("faces",     ["faces"],             "_loadFaces",     "_skipFaces"),
+		("texs",      ["texs"],              "_loadTexs",      "_skipTexs"),
+		("materials", ["materials"],         "_loadMaterials", "_skipMaterials"),
+		("bones",     [
+			"bones", "boneMap", "iks", "ikLinks", "ikOffsets",
+		],                                   "_loadBones",     "_skipBones"),
+		("morphs",    [
+			"morphs", "skeyMap",
+			"groupMorphs", "groupMorphOffsets",
+			"vertMorphs", "vertMorphOffsets",
+			"uvMorphs", "uvMorphOffsets",
+		],                                   "_loadMorphs",    "_skipMorphs"),
+		("frames",    [],                    "_skipFrames",    "_skipFrames"),
+		("rigids",    ["rigids"],            "_loadRigids",    "_skipRigids"),
+		("joints",    ["joints"],            "_loadJoints",    "_skipJoints"),
+	]
+
+	def load( self, file, bulk = True, mapped = False, lazy = False, optimize = False, lods = (), compact = False ):
+		# if mapped, faces and vertices are read-only views into the mapped
+		# file where the layout allows (faces keep their on-disk index width).
+		# if lazy, only the offsets of the sections are indexed here and each
+		# section is decoded on the first access to its attributes.  if
+		# optimize, the mesh is optimized by optimize() after loading, if
+		# lods, the levels of buildLods( lods ) are built, and then if
+		# compact, the vertices are packed by compact().
+		if lazy and (optimize or lods or compact):
+			raise ValueError()
+		if mapped or lazy:
+			self._file = mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ )
+			self._file.seek( file.tell() )
+		else:
+			self._file = file
+		self._map = self._file if mapped else None
+		self._bulk = bulk
 		self._loadHeader()
 		self._loadInfo()
-		self._loadVerts()
-		self._loadFaces()
-		self._loadTexs()
-		self._loadMaterials()
-		self._loadBones()
+		if lazy:
+			self._index = {}
+			for (name, _, _, skip) in self.sections:
+				self._index[name] = self._file.tell()
+				getattr( self, skip )()
+		else:
+			for (_, _, load, _) in self.sections:
+				getattr( self, load )()
+			self._remapWeights()
+			if optimize:
+				self.optimize()
+			if lods:
+				self.buildLods( lods )
+			if compact:
+				self.compact()
+
+	def __getattr__( self, key ):
+		# called only if the attribute is not set yet.
+		if not key.startswith( "_" ) and "_index" in vars( self ):
+			for (name, attrs, load, _) in self.sections:
+				if key in attrs and name in self._index:
+					self._file.seek( self._index.pop( name ) )
+					getattr( self, load )()
+					if name == "verts":
+						self._remapWeights()
+					return getattr( self, key )
+		raise AttributeError( key )
+
+	def optimize( self, size = 32 ):
+		# merges bit-identical vertices, reorders the triangles of each
+		# material for a post-transform cache of the size and then the
+		# vertices by their first use (see meshopt).  the vertices of vertex
+		# and UV morphs are not merged.  self.acmr is the average cache miss
+		# ratio (before, after).
+		verts = self.verts
+		weights = self.weights
+		N = len( verts )
+		faces = numpy.asarray( self.faces, dtype = numpy.int64 )
+		before = meshopt.acmr( faces, size )
+
+		keys = numpy.concatenate( [
+			numpy.ascontiguousarray( recs[name] ).view( numpy.uint8 ).reshape( (N, -1) )
+			for recs in (verts, weights)
+			for name in recs.dtype.names
+		], axis = 1 )
+		keep = numpy.zeros( (N,), bool )
+		keep[self.vertMorphs.vert] = True
+		keep[self.uvMorphs.vert] = True
+		remap = meshopt.dedupe( keys, keep )
+		faces = remap[faces]
+		for m in self.materials:
+			tris = faces[m.bgn // 3 : m.end // 3]
+			tris[:] = tris[meshopt.forsyth( tris, size )]
+
+		order = meshopt.fetchOrder( faces, N )
+		order = order[remap[order] == order] # drops the merged ones
+		inv = numpy.full( (N,), -1, numpy.int64 )
+		inv[order] = numpy.arange( len( order ) )
+
+		self.verts = numpy.recarray( (len( order ),), dtype = [
+			(name, verts.dtype.fields[name][0]) for name in verts.dtype.names
+		] )
+		for name in verts.dtype.names:
+			self.verts[name] = verts[name][order]
+		self.weights = weights[order]
+		self.faces = inv[faces].astype( self.faces.dtype )
+		self.vertMorphs = self.vertMorphs.copy()
+		self.vertMorphs.vert = inv[self.vertMorphs.vert]
+		self.uvMorphs = self.uvMorphs.copy()
+		self.uvMorphs.vert = inv[self.uvMorphs.vert]
+		self.acmr = (before, meshopt.acmr( self.faces, size ))
+
+	def buildLods( self, ratios = (0.5, 0.25, 0.125), size = 32 ):
+		# simplified faces of each material for the decreasing ratios of its
+		# triangles (see lod.simplify), ordered for a post-transform cache of
+		# the size.  vertices on UV seams or shared by materials are kept.
+		# the faces of the material i at the level l (1 for the first ratio;
+		# 0 is self.faces) are lodFaces[bgn // 3 : end // 3] of (bgn, end) =
+		# lodRanges[l - 1, i] like pmx.Material.
+		pos = numpy.asarray( self.verts.vert, dtype = numpy.float64 )
+		faces = numpy.asarray( self.faces, dtype = numpy.int64 )
+		locked = lod.locks( pos, faces, self.materials )
+		levels = [ [] for _ in ratios ]
+		for m in self.materials:
+			tris = faces[m.bgn // 3 : m.end // 3]
+			simple = lod.simplify( pos, tris, [ int( len( tris ) * r ) for r in ratios ], locked )
+			for (l, dst) in enumerate( levels ):
+				# the smallest reached if the ratio is not.
+				s = simple[min( l, len( simple ) - 1 )] if simple else tris
+				dst.append( s[meshopt.forsyth( s, size )] )
+
+		self.lodRanges = numpy.zeros( (len( ratios ), len( self.materials ), 2), numpy.int64 )
+		self.lodFaces = numpy.empty( (sum( len( s ) for dst in levels for s in dst ), 3), self.faces.dtype )
+		bgn = 0
+		for (l, dst) in enumerate( levels ):
+			for (i, s) in enumerate( dst ):
+				self.lodRanges[l, i] = (bgn, bgn + s.size)
+				self.lodFaces[bgn // 3 : bgn // 3 + len( s )] = s
+				bgn += s.size
+
+	def compact( self ):
+		# replaces verts and weights by the quantized packedVerts,
+		# packedWeights and packedSdef (SDEF vertices only), which decode()
+		# turns back to verts and weights (see vertices).  the worst-case
+		# errors are:
+		#   positions and SDEF points: 0.5 / 65535 of the extent of the model
+		#     (packedRange) on each axis, as uint16 in it.
+		#   normals: 0.02 degrees, as octahedral int16 pairs.
+		#   UVs: 2 ** -11 relative, as float16.
+		#   weights: 2 / 255 each and 0.5 / 255 for the sum, as uint8.
+		# (and the float32 rounding of the decoded values.)  bone indices keep
+		# the width of the file.  it is about a third of the size or less.
+		verts, weights = self.vertices()
+		N = len( verts )
+		sdef = numpy.nonzero( weights.type == 3 )[0]
+		points = numpy.concatenate( [ verts.vert, weights.sdef[sdef].reshape( (-1, 3) ) ] ).astype( numpy.float64 )
+		self.packedRange = numpy.array( [
+			points.min( axis = 0 ) if N > 0 else numpy.zeros( 3 ),
+			points.max( axis = 0 ) if N > 0 else numpy.zeros( 3 ),
+		], dtype = numpy.float32 )
+		lo, hi = self.packedRange.astype( numpy.float64 )
+
+		exUv = [ ("exUv", numpy.float16, verts.dtype["exUv"].shape) ] if "exUv" in verts.dtype.names else []
+		packed = numpy.recarray( (N,), dtype = [
+			("vert", numpy.uint16,  (3,)),
+			("norm", numpy.int16,   (2,)),
+			("uv",   numpy.float16, (2,)),
+		] + exUv )
+		packed.vert = quantize.unorm16( verts.vert, lo, hi )
+		packed.norm = quantize.octEncode( verts.norm )
+		packed.uv = verts.uv
+		if exUv:
+			packed.exUv = verts.exUv
+
+		packedWeights = numpy.recarray( (N,), dtype = [
+			("type",   numpy.uint8),
+			("bone",   "<" + self._tBone, (4,)),
+			("weight", numpy.uint8,       (4,)),
+		] )
+		packedWeights.type = weights.type
+		packedWeights.bone = weights.bone
+		packedWeights.weight = quantize.unorm8( weights.weight )
+		packedSdef = numpy.recarray( (len( sdef ),), dtype = [
+			("vert", numpy.int32),
+			("sdef", numpy.uint16, (3, 3)),
+		] )
+		packedSdef.vert = sdef
+		packedSdef.sdef = quantize.unorm16( weights.sdef[sdef], lo, hi )
+
+		self.packedVerts = packed
+		self.packedWeights = packedWeights
+		self.packedSdef = packedSdef
+		vars( self ).pop( "verts", None )
+		vars( self ).pop( "weights", None )
+		vars( self ).pop( "_decoded", None )
+
+	def vertices( self ):
+		# (verts, weights), decoded if compact.
+		if "packedVerts" in vars( self ):
+			return self.decode()
+		return self.verts, self.weights
+
+	def decode( self ):
+		# float32 (verts, weights) of the packed ones of compact(), decoded
+		# once and kept until the next compact(), so writes to them stay.
+		if "_decoded" in vars( self ):
+			return self._decoded
+		lo, hi = self.packedRange.astype( numpy.float64 )
+		packed = self.packedVerts
+		N = len( packed )
+		exUv = [ ("exUv", numpy.float32, packed.dtype["exUv"].shape) ] if "exUv" in packed.dtype.names else []
+		verts = numpy.recarray( (N,), dtype = [
+			("vert", numpy.float32, (3,)),
+			("norm", numpy.float32, (3,)),
+			("uv",   numpy.float32, (2,)),
+		] + exUv )
+		verts.vert = quantize.fromUnorm16( packed.vert, lo, hi )
+		verts.norm = quantize.octDecode( packed.norm )
+		verts.uv = packed.uv
+		if exUv:
+			verts.exUv = packed.exUv
+
+		weights = self._weights( N )
+		weights.type = self.packedWeights.type
+		weights.bone = self.packedWeights.bone
+		weights.weight = quantize.fromUnorm8( self.packedWeights.weight )
+		weights.sdef[self.packedSdef.vert] = quantize.fromUnorm16( self.packedSdef.sdef, lo, hi )
+		self._decoded = (verts, weights)
+		return self._decoded
+
+	def count( self, name ):
+		# number of records of a section, read without decoding it if lazy.
+		if "_index" in vars( self ) and name in self._index:
+			self._file.seek( self._index[name] )
+			N, = self._unpack( "i" )
+			return N // 3 if name == "faces" else N
+		if name in ("verts", "weights") and "packedVerts" in vars( self ):
+			return len( self.packedVerts )
+		return len( getattr( self, name ) )
 
 	def _unpack( self, fmt ):
 		return struct.unpack( fmt, self._file.read( struct.calcsize( fmt ) ) )
 
+	def _skip( self, fmt ):
+		# the eager loader may read a stream, which cannot seek.
+		n = struct.calcsize( "=" + fmt )
+		if isinstance( self._file, mmap.mmap ):
+			self._file.seek( n, os.SEEK_CUR )
+		elif len( self._file.read( n ) ) != n:
+			raise ValueError()
+
 	def _typeSig( self, size ):
-		return (
-			"B" if size == 1 else
-			"H" if size == 2 else
-			"i" if size == 4 else
-			None
-		)
+		if size == 1:
+			return "B"
+		if size == 2:
+			return "H"
+		if size == 4:
+			return "i"
+		raise ValueError()
 
 	def _loadHeader( self ):
 		magic, ver, size = self._unpack( "4s f B" )
@@ -73,62 +320,241 @@ class Loader( object ):
 		self._tTex  = self._typeSig( data[3] ).lower() # type of texture indices
 		self._tMat  = self._typeSig( data[4] ).lower() # type of material indices
 		self._tBone = self._typeSig( data[5] ).lower() # type of material indices
+		self._tMorph = self._typeSig( data[6] ).lower() # type of morph indices
+		self._tRigid = self._typeSig( data[7] ).lower() # type of rigid body indices
 	
 	def _loadStr( self ):
 		N  = self._unpack( "i" )
 		s, = self._unpack( "%ds" % N )
 		return str( s, self._encoding )
 
+	def _skipStr( self ):
+		N, = self._unpack( "i" )
+		self._skip( "%ds" % N )
+
 	def _loadInfo( self ):
 		self._loadStr()
 		self._loadStr()
 		self._loadStr()
 		self._loadStr()
 	
+	def _vertType( self, order = "=" ):
+		return [
+			("vert", order + "f4", (3,)),
+			("norm", order + "f4", (3,)),
+			("uv",   order + "f4", (2,)),
+		] + ([
+			("exUv", order + "f4", (self._nUv, 4)),
+		] if self._nUv > 0 else [])
+
+	def _weights( self, N ):
+		# up to 4 bones per vertex; unused ones are -1 with weight 0.
+		weights = numpy.recarray( (N,), dtype = [
+			("type",   numpy.uint8), # BDEF1, BDEF2, BDEF4, SDEF
+			("bone",   numpy.int32,   (4,)),
+			("weight", numpy.float32, (4,)),
+			("sdef",   numpy.float32, (3, 3)), # C, R0, R1
+		] )
+		weights.bone = -1
+		weights.weight = 0.0
+		weights.sdef = 0.0
+		return weights
+
+	def _remapWeights( self ):
+		# weights refer to the bones in the file order until here.
+		self.bones # decodes the bone section if lazy
+		bone = self.weights.bone
+		self.weights.bone = numpy.where( bone >= 0, self._boneInv[bone], -1 )
+
 	def _loadVerts( self ):
+		if self._bulk and (isinstance( self._file, mmap.mmap ) or self._file.seekable()):
+			self._loadVertsBulk()
+		else:
+			self._loadVertsEach()
+
+	def _loadVertsEach( self ):
 		N, = self._unpack( "i" )
-		verts = numpy.recarray( (N,), dtype = [
-			("vert", numpy.float32, (3,)),
-			("norm", numpy.float32, (3,)),
-			("uv",   numpy.float32, (2,)),
-		] )
+		verts = numpy.recarray( (N,), dtype = self._vertType() )
+		weights = self._weights( N )
 		for i in range( N ):
 			verts[i].vert[:] = self._unpack( "3f" )
 			verts[i].norm[:] = self._unpack( "3f" )
 			verts[i].uv[:]   = self._unpack( "2f" )
 
-			for _ in range( self._nUv ):
-				self._unpack( "4f" )
+			for j in range( self._nUv ):
+				verts[i].exUv[j] = self._unpack( "4f" )
 
 			wt, = self._unpack( "B" )
+			w = weights[i]
+			w.type = wt
 			if wt == 0:
-				self._unpack( self._tBone )
+				w.bone[0], = self._unpack( self._tBone )
+				w.weight[0] = 1.0
 			elif wt == 1:
-				self._unpack( "2%s 1f" % self._tBone )
+				w.bone[0], w.bone[1], w.weight[0] = self._unpack( "=2%s 1f" % self._tBone )
+				w.weight[1] = 1.0 - w.weight[0]
 			elif wt == 2:
-				self._unpack( "4%s 4f" % self._tBone )
+				data = self._unpack( "=4%s 4f" % self._tBone )
+				w.bone[:] = data[:4]
+				w.weight[:] = data[4:]
 			elif wt == 3:
-				self._unpack( "2%s 1f 3f 3f 3f" % self._tBone )
+				data = self._unpack( "=2%s 1f 3f 3f 3f" % self._tBone )
+				w.bone[:2] = data[:2]
+				w.weight[:2] = [ data[2], 1.0 - data[2] ]
+				w.sdef[:] = numpy.reshape( data[3:], (3, 3) )
 			else:
-				ValueError()
+				raise ValueError()
 
 			self._unpack( "f" )
 
 		self.verts = verts
+		self.weights = weights
+
+	def _vertSizes( self ):
+		# record sizes of BDEF1, BDEF2, BDEF4, SDEF (+ weight type and edge
+		# scale) after the fixed-length head.
+		head = 32 + 16 * self._nUv
+		nb = struct.calcsize( self._tBone )
+		return head, [
+			head + 1 + 1 * nb +  0 + 4,
+			head + 1 + 2 * nb +  4 + 4,
+			head + 1 + 4 * nb + 16 + 4,
+			head + 1 + 2 * nb + 40 + 4,
+		]
+
+	def _scanVerts( self, buf, off, N ):
+		# the weight block is variable-length: the weight types of consecutive
+		# records are picked out by a regular expression (in C), the record
+		# boundaries are the cumulative sum of their sizes, and all of them
+		# are checked at once against the types at the boundaries.
+		head, sizes = self._vertSizes()
+		pattern = re.compile( b"(?s).{%d}(?=([\\x00-\\x03]))(?:%s)" % (head, b"|".join(
+			b"\\x%02x.{%d}" % (wt, size - head - 1) for (wt, size) in enumerate( sizes )
+		)) )
+		end = min( len( buf ), off + N * max( sizes ) )
+		types = numpy.frombuffer( b"".join( pattern.findall( buf, off, end )[:N] ), numpy.uint8 )
+		if len( types ) != N:
+			raise ValueError()
+		offs = numpy.empty( (N + 1,), numpy.int64 )
+		offs[0] = off
+		numpy.cumsum( numpy.array( sizes, numpy.int64 )[types], out = offs[1:] )
+		offs[1:] += off
+		if numpy.any( numpy.frombuffer( buf, numpy.uint8, end - off, off )[offs[:-1] - off + head] != types ):
+			raise ValueError()
+		return offs[:-1], int( offs[-1] )
+
+	def _skipVerts( self ):
+		N, = self._unpack( "i" )
+		_, end = self._scanVerts( self._file, self._file.tell(), N )
+		self._file.seek( end )
+
+	def _loadVertsBulk( self ):
+		# find the record boundaries in a single scan and then gather the
+		# fixed-length heads at once.
+		N, = self._unpack( "i" )
+		pos = self._file.tell()
+		head, sizes = self._vertSizes()
+		if isinstance( self._file, mmap.mmap ):
+			buf, bgn = self._file, pos
+		else:
+			# no more than the largest the section can be.
+			buf, bgn = self._file.read( N * max( sizes ) ), 0
+
+		offs, off = self._scanVerts( buf, bgn, N )
+		self._file.seek( pos + off - bgn )
+
+		self.weights = self._gatherWeights( buf, offs, head )
+
+		steps = numpy.diff( offs, append = off )
+		if self._map is not None and N > 0 and numpy.all( steps == steps[0] ):
+			# all the records have the same size.
+			rec = numpy.dtype( self._vertType( "<" ) )
+			self.verts = numpy.recarray( (N,), dtype = numpy.dtype( {
+				"names":    rec.names,
+				"formats":  [ rec.fields[k][0] for k in rec.names ],
+				"offsets":  [ rec.fields[k][1] for k in rec.names ],
+				"itemsize": int( steps[0] ),
+			} ), buf = buf, offset = bgn )
+			return
+
+		# every byte offset viewed as the start of a record head.
+		heads = numpy.ndarray(
+			(max( len( buf ) - head + 1, 0 ),), dtype = self._vertType( "<" ),
+			buffer = buf, strides = (1,),
+		)[offs]
+		verts = numpy.recarray( (N,), dtype = self._vertType() )
+		for (name, _, _) in self._vertType():
+			verts[name] = heads[name]
+
+		self.verts = verts
+
+	def _gatherWeights( self, buf, offs, head ):
+		offs = numpy.asarray( offs, dtype = numpy.int64 ) + head
+		weights = self._weights( len( offs ) )
+		weights.type = numpy.frombuffer( buf, numpy.uint8 )[offs]
+
+		b = "<" + self._tBone
+		blocks = [ # BDEF1, BDEF2, BDEF4, SDEF
+			[ ("bone", b, (1,)) ],
+			[ ("bone", b, (2,)), ("weight", "<f4", (1,)) ],
+			[ ("bone", b, (4,)), ("weight", "<f4", (4,)) ],
+			[ ("bone", b, (2,)), ("weight", "<f4", (1,)), ("sdef", "<f4", (3, 3)) ],
+		]
+		for (wt, block) in enumerate( blocks ):
+			idx = numpy.nonzero( weights.type == wt )[0]
+			if len( idx ) == 0:
+				continue
+			block = numpy.dtype( block )
+			recs = numpy.ndarray(
+				(len( buf ) - block.itemsize + 1,), dtype = block,
+				buffer = buf, strides = (1,),
+			)[offs[idx] + 1]
+
+			n = block["bone"].shape[0]
+			weights.bone[idx, :n] = recs["bone"]
+			if wt == 0:
+				weights.weight[idx, 0] = 1.0
+			elif wt == 2:
+				weights.weight[idx] = recs["weight"]
+			else:
+				weights.weight[idx, 0] = recs["weight"][:, 0]
+				weights.weight[idx, 1] = 1.0 - recs["weight"][:, 0]
+			if wt == 3:
+				weights.sdef[idx] = recs["sdef"]
+
+		return weights
 
 	def _loadFaces( self ):
 		N, = self._unpack( "i" )
 		if N % 3 != 0:
 			raise ValueError()
 
-		self.faces = numpy.empty( [N // 3, 3], numpy.uint32 )
-		for i in range( N // 3 ):
-			self.faces[i, :] = self._unpack( "3%s" % self._tVert )
+		dtype = numpy.dtype( "<" + self._tVert.replace( "i", "I" ) )
+		if self._map is not None:
+			pos = self._file.tell()
+			faces = numpy.frombuffer( self._map, dtype, N, pos )
+			self._file.seek( pos + N * dtype.itemsize )
+		else:
+			buf = self._file.read( N * dtype.itemsize )
+			if len( buf ) != N * dtype.itemsize:
+				raise ValueError()
+			faces = numpy.frombuffer( buf, dtype ).astype( numpy.uint32 )
+
+		self.faces = faces.reshape( (N // 3, 3) )
 	
+	def _skipFaces( self ):
+		N, = self._unpack( "i" )
+		self._skip( "%d%s" % (N, self._tVert) )
+
 	def _loadTexs( self ):
 		N, = self._unpack( "i" )
 		self.texs = [ self._loadStr().replace( "\\", "/" ) for _ in range( N ) ]
 	
+	def _skipTexs( self ):
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+
 	def _loadMaterials( self ):
 		self.materials = []
 		N, = self._unpack( "i" )
@@ -165,6 +591,18 @@ class Loader( object ):
 			) )
 			bgn += size
 	
+	def _skipMaterials( self ):
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+			self._skipStr()
+			self._skip( "4f 3f 1f 3f 1B 4f 1f" )
+			self._skip( "2%s 1B" % self._tTex )
+			isToon, = self._unpack( "1B" )
+			self._skip( self._tTex if isToon == 0 else "1B" )
+			self._skipStr()
+			self._skip( "1i" )
+
 	def _loadBones( self ):
 		N, = self._unpack( "i" )
 		bones = numpy.recarray( (N,), dtype = [
@@ -173,6 +611,8 @@ class Loader( object ):
 			("after",  numpy.bool),
 		] )
 		boneMap = {}
+		iks = []
+		links = []
 		for i in range( N ):
 			name = unicodedata.normalize( "NFKC", self._loadStr() )
 			boneMap[name] = i
@@ -199,15 +639,231 @@ class Loader( object ):
 				self._unpack( "1i" )
 			if flag & 0x0020 != 0:
 				tb, = self._unpack( self._tBone )
-				self._unpack( "1i" )
-				self._unpack( "1f" )
+				loops, = self._unpack( "1i" )
+				limit, = self._unpack( "1f" )
 				nLink, = self._unpack( "1i" )
+				iks.append( (i, tb, loops, limit, nLink) )
 				for _ in range( nLink ):
 					lb, = self._unpack( self._tBone )
 					c, = self._unpack( "1B" )
 					if c != 0:
-						self._unpack( "3f" )
-						self._unpack( "3f" )
+						lower = self._unpack( "3f" )
+						upper = self._unpack( "3f" )
+					else:
+						lower = upper = (0.0, 0.0, 0.0)
+					links.append( (lb, c != 0, lower, upper) )
+
+		# bones are stored in the topological order, and the parents and
+		# boneMap refer to that order.
+		order = argTopoSort( bones.parent )
+		inv = numpy.empty( (N,), numpy.int32 )
+		inv[order] = numpy.arange( N )
+		bones = bones[order]
+		bones.parent = numpy.where( bones.parent >= 0, inv[bones.parent], -1 )
+		self._boneInv = inv
+		self.bones = bones
+		self.boneMap = { k: int( inv[v] ) for (k, v) in boneMap.items() }
+
+		# IK chains: the IK bone (the goal) moves the target bone by rotating
+		# the links ikLinks[ikOffsets[i] : ikOffsets[i + 1]], from the target
+		# side, up to loops times by at most limit radians per step.  limited
+		# links keep their rotation within the Euler angles lower / upper.
+		self.iks = numpy.recarray( (len( iks ),), dtype = [
+			("bone",   numpy.int32),
+			("target", numpy.int32),
+			("loops",  numpy.int32),
+			("limit",  numpy.float32),
+		] )
+		self.ikLinks = numpy.recarray( (len( links ),), dtype = [
+			("bone",    numpy.int32),
+			("limited", numpy.bool),
+			("lower",   numpy.float32, (3,)),
+			("upper",   numpy.float32, (3,)),
+		] )
+		self.ikOffsets = numpy.zeros( (len( iks ) + 1,), numpy.int64 )
+		for (k, (i, tb, loops, limit, nLink)) in enumerate( iks ):
+			self.iks[k] = (inv[i], numpy.where( tb >= 0, inv[tb], -1 ), loops, limit)
+			self.ikOffsets[k + 1] = self.ikOffsets[k] + nLink
+		for (k, (lb, limited, lower, upper)) in enumerate( links ):
+			self.ikLinks[k] = (numpy.where( lb >= 0, inv[lb], -1 ), limited, lower, upper)
+
+	def _skipBones( self ):
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+			self._skipStr()
+			self._skip( "3f %s 1i" % self._tBone )
+			flag, = self._unpack( "1H" )
+			self._skip( "3f" if flag & 0x0001 == 0 else self._tBone )
+			if flag & (0x0100 | 0x0200) != 0:
+				self._skip( "%s 1f" % self._tBone )
+			if flag & 0x0400 != 0:
+				self._skip( "3f" )
+			if flag & 0x0800 != 0:
+				self._skip( "3f 3f" )
+			if flag & 0x2000 != 0:
+				self._skip( "1i" )
+			if flag & 0x0020 != 0:
+				self._skip( "%s 1i 1f" % self._tBone )
+				nLink, = self._unpack( "1i" )
+				for _ in range( nLink ):
+					self._skip( self._tBone )
+					c, = self._unpack( "1B" )
+					if c != 0:
+						self._skip( "3f 3f" )
+
+	def _morphType( self, t ):
+		# packed on-disk offset record of the morph type t.
+		v = "<" + self._tVert.replace( "i", "I" )
+		if t == 0 or t == 9: # group, flip
+			return numpy.dtype( [ ("morph", "<" + self._tMorph), ("weight", "<f4") ] )
+		elif t == 1: # vertex
+			return numpy.dtype( [ ("vert", v), ("offset", "<f4", (3,)) ] )
+		elif t == 2: # bone
+			return numpy.dtype( [ ("bone", "<" + self._tBone), ("loc", "<f4", (3,)), ("rot", "<f4", (4,)) ] )
+		elif 3 <= t <= 7: # UV, extra UV 1-4
+			return numpy.dtype( [ ("vert", v), ("offset", "<f4", (4,)) ] )
+		elif t == 8: # material
+			return numpy.dtype( [ ("material", "<" + self._tMat), ("op", "u1"), ("params", "<f4", (28,)) ] )
+		elif t == 10: # impulse
+			return numpy.dtype( [ ("rigid", "<" + self._tRigid), ("local", "u1"), ("params", "<f4", (6,)) ] )
+		else:
+			raise ValueError()
+
+	def _csr( self, rows, N, dtype ):
+		# (morph, records) in the morph order to a table and its offsets: the
+		# records of the morph i are table[offsets[i] : offsets[i + 1]].
+		counts = numpy.zeros( (N,), numpy.int64 )
+		table = numpy.recarray( (sum( len( r ) for (_, r) in rows ),), dtype = dtype )
+		bgn = 0
+		for (i, recs) in rows:
+			counts[i] = len( recs )
+			for name in table.dtype.names:
+				table[name][bgn : bgn + len( recs )] = recs[name]
+			bgn += len( recs )
+		offsets = numpy.zeros( (N + 1,), numpy.int64 )
+		numpy.cumsum( counts, out = offsets[1:] )
+		return table, offsets
+
+	def _loadMorphs( self ):
+		# group, vertex and UV morphs are kept as sparse tables indexed by
+		# morph (see _csr).  the other types are only listed in self.morphs.
+		N, = self._unpack( "i" )
+		morphs = numpy.recarray( (N,), dtype = [
+			("panel", numpy.uint8),
+			("type",  numpy.uint8),
+		] )
+		skeyMap = {}
+		rows = { 0: [], 1: [], 3: [] }
+		for i in range( N ):
+			name = unicodedata.normalize( "NFKC", self._loadStr() )
+			skeyMap[name] = i
+			self._loadStr()
+			morphs[i].panel, morphs[i].type = self._unpack( "2B" )
+			n, = self._unpack( "i" )
+			dtype = self._morphType( morphs[i].type )
+			buf = self._file.read( n * dtype.itemsize )
+			if len( buf ) != n * dtype.itemsize:
+				raise ValueError()
+			if morphs[i].type in rows:
+				rows[morphs[i].type].append( (i, numpy.frombuffer( buf, dtype )) )
+
+		self.morphs = morphs
+		self.skeyMap = skeyMap
+		self.groupMorphs, self.groupMorphOffsets = self._csr( rows[0], N, [
+			("morph",  numpy.int32),
+			("weight", numpy.float32),
+		] )
+		self.vertMorphs, self.vertMorphOffsets = self._csr( rows[1], N, [
+			("vert",   numpy.int32),
+			("offset", numpy.float32, (3,)),
+		] )
+		self.uvMorphs, self.uvMorphOffsets = self._csr( rows[3], N, [
+			("vert",   numpy.int32),
+			("offset", numpy.float32, (4,)),
+		] )
+
+	def _skipMorphs( self ):
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+			self._skipStr()
+			_, t, n = self._unpack( "=2B i" )
+			self._file.seek( n * self._morphType( t ).itemsize, os.SEEK_CUR )
+
+	def _skipFrames( self ):
+		# display frames are not used.
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+			self._skipStr()
+			_, n = self._unpack( "=B i" )
+			for _ in range( n ):
+				t, = self._unpack( "B" )
+				self._skip( self._tBone if t == 0 else self._tMorph )
+
+	def _loadRigids( self ):
+		N, = self._unpack( "i" )
+		rigids = numpy.recarray( (N,), dtype = [
+			("bone",        numpy.int32),
+			("group",       numpy.uint8),
+			("mask",        numpy.uint16), # groups not collided with
+			("shape",       numpy.uint8),  # sphere, box, capsule
+			("size",        numpy.float32, (3,)),
+			("pos",         numpy.float32, (3,)),
+			("rot",         numpy.float32, (3,)), # Euler angles
+			("mass",        numpy.float32),
+			("linDamping",  numpy.float32),
+			("angDamping",  numpy.float32),
+			("restitution", numpy.float32),
+			("friction",    numpy.float32),
+			("mode",        numpy.uint8),  # follow bone, dynamic, dynamic + bone position
+		] )
+		fmt = "=%s B H B 3f 3f 3f 5f B" % self._tBone
+		for i in range( N ):
+			self._skipStr()
+			self._skipStr()
+			data = self._unpack( fmt )
+			rigids[i] = data[:4] + (data[4:7], data[7:10], data[10:13]) + data[13:]
+
+		# bone indices refer to the file order until here.
+		bone = rigids.bone.copy()
+		self.bones # decodes the bone section if lazy
+		rigids.bone = numpy.where( bone >= 0, self._boneInv[bone], -1 )
+		self.rigids = rigids
+
+	def _skipRigids( self ):
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+			self._skipStr()
+			self._skip( "%s B H B 3f 3f 3f 5f B" % self._tBone )
+
+	def _loadJoints( self ):
+		N, = self._unpack( "i" )
+		joints = numpy.recarray( (N,), dtype = [
+			("type",      numpy.uint8), # 6DOF spring, ...
+			("rigids",    numpy.int32,   (2,)),
+			("pos",       numpy.float32, (3,)),
+			("rot",       numpy.float32, (3,)),
+			("posLower",  numpy.float32, (3,)),
+			("posUpper",  numpy.float32, (3,)),
+			("rotLower",  numpy.float32, (3,)),
+			("rotUpper",  numpy.float32, (3,)),
+			("posSpring", numpy.float32, (3,)),
+			("rotSpring", numpy.float32, (3,)),
+		] )
+		fmt = "=B 2%s 24f" % self._tRigid
+		for i in range( N ):
+			self._skipStr()
+			self._skipStr()
+			data = self._unpack( fmt )
+			joints[i] = (data[0], data[1:3]) + tuple( numpy.reshape( data[3:], (8, 3) ) )
+		self.joints = joints
 
-		self.bones = bones[argTopoSort( bones.parent )]
-		self.boneMap = boneMap
+	def _skipJoints( self ):
+		N, = self._unpack( "i" )
+		for _ in range( N ):
+			self._skipStr()
+			self._skipStr()
+			self._skip( "B 2%s 24f" % self._tRigid )
@@ -0,0 +1,117 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import threading
+import collections
+import numpy
+
+
+# LRU cache of the absolute poses (aRot, aLoc, aMat) of animation.Animation
+# and skeleton.Skeleton pairs at quantized frames, keyed by (motion, binding,
+# frame).  the binding is rebuilt whenever the keys of the motion change, so
+# stale poses are never hit.  a hit copies the cached arrays.  poses of IK
+# solves stopped by the time budget of ik.IK depend on the machine load, so
+# they are returned but not cached.
+class PoseCache( object ):
+
+	def __init__( self, maxSize = 64 << 20, quantum = 1.0 / 16.0 ):
+		self.maxSize = maxSize
+		self.quantum = quantum
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._evalLock = threading.Lock()
+		self._prewarmId = 0
+
+	def pose( self, anim, skel, frame, aRot, aLoc, aMat, ik = None ):
+		# the pose at the frame rounded to a multiple of the quantum, solved
+		# by ik.IK if given.
+		entry = self._get( anim, skel, ik, int( round( frame / self.quantum ) ), True )
+		numpy.copyto( aRot, entry[0] )
+		numpy.copyto( aLoc, entry[1] )
+		numpy.copyto( aMat, entry[2] )
+
+	def prewarm( self, anim, skel, frame, ahead = 60.0, behind = 0.0, ik = None ):
+		# evaluates the frames around the playhead in a background thread,
+		# the nearest first.  a newer call stops the previous one.
+		self._prewarmId += 1
+		q = int( round( frame / self.quantum ) )
+		qs = range( q - int( behind / self.quantum ), q + int( ahead / self.quantum ) + 1 )
+		thread = threading.Thread(
+			target = self._prewarm, args = (self._prewarmId, anim, skel, ik, sorted( qs, key = lambda i: abs( i - q ) )),
+			daemon = True,
+		)
+		thread.start()
+		return thread
+
+	def morphs( self, anim, frame, weights ):
+		# the morph weights of anim at the frame, evaluated under the lock of
+		# the poses as they update the same animation.
+		with self._evalLock:
+			anim.evaluateMorphs( frame, weights )
+
+	def clear( self ):
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+
+	def _prewarm( self, serial, anim, skel, ik, qs ):
+		for q in qs:
+			if self._prewarmId != serial:
+				break
+			self._get( anim, skel, ik, q, False )
+
+	def _get( self, anim, skel, ik, q, count ):
+		# Animation.update and the evaluation are not reentrant, so they are
+		# run under _evalLock, and the entries are guarded by _lock.  lookups
+		# do not wait for a computation in progress, whose update is recent,
+		# but a miss waits for it (one frame of prewarm at most).
+		if self._evalLock.acquire( blocking = False ):
+			try:
+				anim.update()
+			finally:
+				self._evalLock.release()
+		entry = self._lookup( (anim.motion, anim.binding, ik, q), count )
+		if entry is not None:
+			return entry
+
+		with self._evalLock:
+			anim.update()
+			key = (anim.motion, anim.binding, ik, q)
+			entry = self._lookup( key, False ) # computed meanwhile
+			if entry is not None:
+				return entry
+			entry = self._compute( anim, skel, ik, q * self.quantum )
+			exact = ik is None or not ik.truncated
+
+		if exact:
+			with self._lock:
+				self._entries[key] = entry
+				self.size += sum( a.nbytes for a in entry )
+				while self.size > self.maxSize and len( self._entries ) > 1:
+					_, old = self._entries.popitem( last = False )
+					self.size -= sum( a.nbytes for a in old )
+		return entry
+
+	def _lookup( self, key, count ):
+		with self._lock:
+			entry = self._entries.get( key )
+			if entry is not None:
+				self._entries.move_to_end( key )
+				self.hits += count
+			else:
+				self.misses += count
+			return entry
+
+	def _compute( self, anim, skel, ik, frame ):
+		N = skel.parents.shape[0]
+		rRot = numpy.empty( (N, 4), numpy.float32 )
+		rLoc = numpy.empty( (N, 3), numpy.float32 )
+		aRot = numpy.empty( (N, 4), numpy.float32 )
+		aLoc = numpy.empty( (N, 3), numpy.float32 )
+		anim.evaluate( frame, rRot, rLoc )
+		skel.forward( rRot, rLoc, aRot, aLoc )
+		if ik is not None:
+			ik.solve( rRot, rLoc, aRot, aLoc )
+		return (aRot, aLoc, skel.matrices( aRot, aLoc ))
@@ -0,0 +1,50 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+
+
+def unorm16( x, lo, hi ):
+	# x in [lo, hi] to uint16 steps of (hi - lo) / 65535.
+	scale = 65535.0 / numpy.maximum( hi - lo, 1e-12 )
+	return numpy.rint( numpy.clip( (x - lo) * scale, 0.0, 65535.0 ) ).astype( numpy.uint16 )
+
+def fromUnorm16( q, lo, hi ):
+	return (q * ((hi - lo) / 65535.0) + lo).astype( numpy.float32 )
+
+
+def octEncode( n ):
+	# unit vectors (..., 3) to int16 (..., 2) of the octahedral map: the
+	# vector projected onto the octahedron, the lower half folded out.
+	n = numpy.asarray( n, dtype = numpy.float64 )
+	l1 = numpy.maximum( numpy.sum( numpy.abs( n ), axis = -1 ), 1e-12 )
+	x = n[..., 0] / l1
+	y = n[..., 1] / l1
+	lower = n[..., 2] < 0.0
+	x, y = (
+		numpy.where( lower, (1.0 - numpy.abs( y )) * numpy.where( x >= 0.0, 1.0, -1.0 ), x ),
+		numpy.where( lower, (1.0 - numpy.abs( x )) * numpy.where( y >= 0.0, 1.0, -1.0 ), y ),
+	)
+	return numpy.rint( numpy.clip( numpy.stack( [ x, y ], axis = -1 ), -1.0, 1.0 ) * 32767.0 ).astype( numpy.int16 )
+
+def octDecode( q ):
+	x = q[..., 0] / 32767.0
+	y = q[..., 1] / 32767.0
+	z = 1.0 - numpy.abs( x ) - numpy.abs( y )
+	t = numpy.maximum( -z, 0.0 )
+	x = x - numpy.where( x >= 0.0, t, -t )
+	y = y - numpy.where( y >= 0.0, t, -t )
+	n = numpy.stack( [ x, y, z ], axis = -1 )
+	return (n / numpy.sqrt( numpy.sum( n * n, axis = -1, keepdims = True ) )).astype( numpy.float32 )
+
+
+def unorm8( w ):
+	# weights (..., K) to uint8 steps of 1 / 255.  the largest takes the
+	# rounding of the sum, so that the sum is kept to 0.5 / 255.
+	q = numpy.rint( numpy.clip( w, 0.0, 1.0 ) * 255.0 ).astype( numpy.int32 )
+	diff = numpy.rint( numpy.clip( numpy.sum( w, axis = -1 ), 0.0, 1.0 ) * 255.0 ).astype( numpy.int32 ) - numpy.sum( q, axis = -1 )
+	top = numpy.argmax( w, axis = -1 )[..., None]
+	numpy.put_along_axis( q, top, numpy.take_along_axis( q, top, axis = -1 ) + diff[..., None], axis = -1 )
+	return numpy.clip( q, 0, 255 ).astype( numpy.uint8 )
+
+def fromUnorm8( q ):
+	return (q * numpy.float32( 1.0 / 255.0 )).astype( numpy.float32 )
@@ -4,57 +4,116 @@ import math
 import numpy
 
 
-def conj( x ):
-	r = numpy.empty_like( x )
-	r[0 ] =  x[0 ]
-	r[1:] = -x[1:]
+# the functions below work on a quaternion (w, x, y, z) or on arrays of them
+# along the last axis, broadcasting the others.  out may be given to reuse
+# storage and may be one of the arguments.
+
+def _out( shape, dtype, out ):
+	return numpy.empty( shape, dtype = dtype ) if out is None else out
+
+def _data( x ):
+	return x._data if isinstance( x, (Quaternion, QuaternionArray) ) else x
+
+def conj( x, out = None ):
+	r = _out( x.shape, x.dtype, out )
+	r[..., 0 ] = x[..., 0]
+	numpy.negative( x[..., 1:], out = r[..., 1:] )
+	return r
+
+def mul( x, y, out = None ):
+	r0 = x[..., 0] * y[..., 0] - x[..., 1] * y[..., 1] - x[..., 2] * y[..., 2] - x[..., 3] * y[..., 3]
+	r1 = x[..., 0] * y[..., 1] + x[..., 1] * y[..., 0] + x[..., 2] * y[..., 3] - x[..., 3] * y[..., 2]
+	r2 = x[..., 0] * y[..., 2] - x[..., 1] * y[..., 3] + x[..., 2] * y[..., 0] + x[..., 3] * y[..., 1]
+	r3 = x[..., 0] * y[..., 3] + x[..., 1] * y[..., 2] - x[..., 2] * y[..., 1] + x[..., 3] * y[..., 0]
+
+	r = _out( numpy.broadcast( x, y ).shape, numpy.result_type( x, y ), out )
+	r[..., 0] = r0
+	r[..., 1] = r1
+	r[..., 2] = r2
+	r[..., 3] = r3
+	return r
+
+def dot( x, y ):
+	return numpy.einsum( "...i,...i->...", x, y )
+
+def norm2( x ):
+	return dot( x, x )
+
+def inv( x, out = None ):
+	n = norm2( x )
+	r = conj( x, out )
+	r /= n[..., None]
+	return r
+
+def div( x, y, out = None ):
+	n = norm2( y )
+	r = mul( x, conj( y ), out )
+	r /= n[..., None]
 	return r
 
-def mul( x, y ):
-	r = numpy.empty_like( x, dtype = numpy.result_type( x, y ) )
-	r[0] = x[0] * y[0] - x[1] * y[1] - x[2] * y[2] - x[3] * y[3]
-	r[1] = x[0] * y[1] + x[1] * y[0] + x[2] * y[3] - x[3] * y[2]
-	r[2] = x[0] * y[2] - x[1] * y[3] + x[2] * y[0] + x[3] * y[1]
-	r[3] = x[0] * y[3] + x[1] * y[2] - x[2] * y[1] + x[3] * y[0]
+def normalize( x, out = None ):
+	n = numpy.sqrt( norm2( x ) )
+	return numpy.divide( x, n[..., None], out = out )
+
+def nlerp( x, y, t, out = None ):
+	# along the shorter arc, 0 <= t <= 1.
+	t = numpy.asarray( t, dtype = x.dtype )
+	u = numpy.copysign( t, dot( x, y ) )
+	return normalize( x * (1.0 - t)[..., None] + y * u[..., None], out )
+
+def slerp( x, y, t, out = None ):
+	# along the shorter arc, 0 <= t <= 1.  falls back to nlerp if x ~ y.
+	t = numpy.asarray( t, dtype = x.dtype )
+	d = dot( x, y )
+	theta = numpy.arccos( numpy.minimum( numpy.abs( d ), 1.0 ) )
+	s = numpy.sin( theta )
+	near = s < 1e-4
+	s = numpy.where( near, 1.0, s )
+	u = numpy.where( near, 1.0 - t, numpy.sin( (1.0 - t) * theta ) / s )
+	v = numpy.where( near, t, numpy.sin( t * theta ) / s )
+	v = numpy.copysign( v, d )
+	return normalize( x * u[..., None] + y * v[..., None], out )
+
+def matrix4( x, out = None ):
+	x00 = x[..., 0] * x[..., 0]
+	x01 = x[..., 0] * x[..., 1]
+	x02 = x[..., 0] * x[..., 2]
+	x03 = x[..., 0] * x[..., 3]
+	x11 = x[..., 1] * x[..., 1]
+	x12 = x[..., 1] * x[..., 2]
+	x13 = x[..., 1] * x[..., 3]
+	x22 = x[..., 2] * x[..., 2]
+	x23 = x[..., 2] * x[..., 3]
+	x33 = x[..., 3] * x[..., 3]
+
+	r = _out( x.shape[:-1] + (4, 4), x.dtype, out )
+	r[..., 0, 0] = x00 + x11 - x22 - x33
+	r[..., 0, 1] = 2.0 * (x12 - x03)
+	r[..., 0, 2] = 2.0 * (x13 + x02)
+	r[..., 1, 0] = 2.0 * (x12 + x03)
+	r[..., 1, 1] = x00 - x11 + x22 - x33
+	r[..., 1, 2] = 2.0 * (x23 - x01)
+	r[..., 2, 0] = 2.0 * (x13 - x02)
+	r[..., 2, 1] = 2.0 * (x23 + x01)
+	r[..., 2, 2] = x00 - x11 - x22 + x33
+	r[..., 3, :3] = 0.0
+	r[..., :3, 3] = 0.0
+	r[..., 3, 3] = 1.0
 	return r
 
-def inv( x ):
-	return conj( x ) / numpy.dot( x, x )
-
-def div( x, y ):
-	return mul( x, conj( y ) ) / numpy.dot( y, y )
-
-def matrix4( x ):
-	x00 = x[0] * x[0]
-	x01 = x[0] * x[1]
-	x02 = x[0] * x[2]
-	x03 = x[0] * x[3]
-	x11 = x[1] * x[1]
-	x12 = x[1] * x[2]
-	x13 = x[1] * x[3]
-	x22 = x[2] * x[2]
-	x23 = x[2] * x[3]
-	x33 = x[3] * x[3]
-	return numpy.array( [
-		[ x00 + x11 - x22 - x33, 2.0 * (x12 - x03),     2.0 * (x13 + x02),     0.0 ],
-		[ 2.0 * (x12 + x03),     x00 - x11 + x22 - x33, 2.0 * (x23 - x01),     0.0 ],
-		[ 2.0 * (x13 - x02),     2.0 * (x23 + x01),     x00 - x11 - x22 + x33, 0.0 ],
-		[ 0.0,                   0.0,                   0.0,                   1.0 ],
-	], dtype = x.dtype )
-
-def transform( q, x ):
+def transform( q, x, out = None ):
 	#r = numpy.zeros( (4,), dtype = x.dtype )
 	#r[1:] = x
 	#return mul( mul( q, r ), conj( q ) )[1:]
 
-	r0 = q[2] * x[2] - q[3] * x[1] + q[0] * x[0]
-	r1 = q[3] * x[0] - q[1] * x[2] + q[0] * x[1]
-	r2 = q[1] * x[1] - q[2] * x[0] + q[0] * x[2]
+	r0 = q[..., 2] * x[..., 2] - q[..., 3] * x[..., 1] + q[..., 0] * x[..., 0]
+	r1 = q[..., 3] * x[..., 0] - q[..., 1] * x[..., 2] + q[..., 0] * x[..., 1]
+	r2 = q[..., 1] * x[..., 1] - q[..., 2] * x[..., 0] + q[..., 0] * x[..., 2]
 
-	s = numpy.empty_like( x )
-	s[0] = (q[2] * r2 - q[3] * r1) * 2.0 + x[0]
-	s[1] = (q[3] * r0 - q[1] * r2) * 2.0 + x[1]
-	s[2] = (q[1] * r1 - q[2] * r0) * 2.0 + x[2]
+	s = _out( numpy.broadcast( q[..., 1:], x ).shape, x.dtype, out )
+	s[..., 0] = (q[..., 2] * r2 - q[..., 3] * r1) * 2.0 + x[..., 0]
+	s[..., 1] = (q[..., 3] * r0 - q[..., 1] * r2) * 2.0 + x[..., 1]
+	s[..., 2] = (q[..., 1] * r1 - q[..., 2] * r0) * 2.0 + x[..., 2]
 	return s
 
 def rotation( axis, theta ):
@@ -68,6 +127,11 @@ def from_float( x, dtype ):
 	r[0] = x
 	return r
 
+def identities( shape, dtype = numpy.float32 ):
+	r = numpy.zeros( tuple( numpy.atleast_1d( shape ) ) + (4,), dtype = dtype )
+	r[..., 0] = 1.0
+	return r
+
 def quaternion( src ):
 	if isinstance( src, float ):
 		r = from_float( src, numpy.float64 )
@@ -188,6 +252,98 @@ class Quaternion( object ):
 		return self._data
 
 
+class QuaternionArray( object ):
+
+	# an array of quaternions, shape (..., 4).  the methods take out (an
+	# ndarray or a QuaternionArray) to write the result into.
+
+	__slots__ = [ "_data" ]
+
+	def __init__( self, data ):
+		assert type( data ) is numpy.ndarray and data.shape[-1] == 4
+		self._data = data
+
+	def __str__( self ):
+		return str( self._data )
+
+	def __repr__( self ):
+		return "QuaternionArray(%s)" % repr( self._data.tolist() )
+
+	def __len__( self ):
+		return len( self._data )
+
+	def __iter__( self ):
+		return ( Quaternion( x ) for x in self._data )
+
+	def __getitem__( self, idx ):
+		r = self._data[idx]
+		return Quaternion( r ) if r.ndim == 1 else QuaternionArray( r )
+
+	def __setitem__( self, idx, val ):
+		self._data[idx] = _data( val )
+
+	def _wrap( self, r, out ):
+		return out if isinstance( out, QuaternionArray ) else QuaternionArray( r )
+
+	def __neg__( self ):
+		return QuaternionArray( -self._data )
+
+	def __mul__( lhs, rhs ):
+		if isinstance( rhs, float ):
+			return QuaternionArray( lhs._data * rhs )
+		elif isinstance( rhs, (Quaternion, QuaternionArray) ):
+			return QuaternionArray( mul( lhs._data, rhs._data ) )
+		else:
+			return NotImplemented
+
+	def __rmul__( rhs, lhs ):
+		if isinstance( lhs, float ):
+			return QuaternionArray( lhs * rhs._data )
+		elif isinstance( lhs, Quaternion ):
+			return QuaternionArray( mul( lhs._data, rhs._data ) )
+		else:
+			return NotImplemented
+
+	def __imul__( self, rhs ):
+		if isinstance( rhs, float ):
+			self._data *= rhs
+		elif isinstance( rhs, (Quaternion, QuaternionArray) ):
+			mul( self._data, rhs._data, self._data )
+		else:
+			return NotImplemented
+		return self
+
+	def mul( self, rhs, out = None ):
+		return self._wrap( mul( self._data, _data( rhs ), _data( out ) ), out )
+
+	def conj( self, out = None ):
+		return self._wrap( conj( self._data, _data( out ) ), out )
+
+	def inv( self, out = None ):
+		return self._wrap( inv( self._data, _data( out ) ), out )
+
+	def normalize( self, out = None ):
+		return self._wrap( normalize( self._data, _data( out ) ), out )
+
+	def nlerp( self, rhs, t, out = None ):
+		return self._wrap( nlerp( self._data, _data( rhs ), t, _data( out ) ), out )
+
+	def slerp( self, rhs, t, out = None ):
+		return self._wrap( slerp( self._data, _data( rhs ), t, _data( out ) ), out )
+
+	def norm2( self ):
+		return norm2( self._data )
+
+	def matrix4( self, out = None ):
+		return matrix4( self._data, out )
+
+	def transform( self, x, out = None ):
+		return transform( self._data, x, out )
+
+	def array( self ):
+		return self._data
+
+
 if __name__ == "__main__":
 	q = quaternion( [0.1, 0.2, 0.3, -0.4] )
 	r = quaternion( [0.5, 0.6, -0.7, 0.8] )
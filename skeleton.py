@@ -0,0 +1,64 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+import quaternion
+
+
+# pmx.Loader.bones precompiled for forward kinematics.  the bones are grouped
+# by their depth in the hierarchy, so that each level is computed by a few
+# batched operations.
+#
+# rotations are (w, x, y, z) and compose as quaternion.mul( parent, child ).
+# the relative location of a bone is added to its rest offset from the
+# parent, and the absolute location is the posed position of the bone origin.
+# poses may have leading axes, e.g. (instances, bones, 4), which are computed
+# by the same operations per level.
+class Skeleton( object ):
+
+	def __init__( self, bones ):
+		N = bones.shape[0]
+		self.parents = numpy.array( bones.parent, dtype = numpy.int32 )
+		self.pos = numpy.array( bones.pos, dtype = numpy.float32 )
+
+		# bones are in the topological order, so parents come first.
+		depth = numpy.zeros( (N,), numpy.int32 )
+		for i in range( N ):
+			if self.parents[i] >= 0:
+				depth[i] = depth[self.parents[i]] + 1
+
+		self.offsets = self.pos.copy()
+		self.offsets[depth > 0] -= self.pos[self.parents[depth > 0]]
+
+		self.levels = []
+		for d in range( depth.max() + 1 if N > 0 else 0 ):
+			idx = numpy.nonzero( depth == d )[0]
+			self.levels.append( (idx, self.parents[idx]) )
+
+	def forward( self, rRot, rLoc, aRot, aLoc ):
+		for (idx, parent) in self.levels:
+			loc = self.offsets[idx] + rLoc[..., idx, :]
+			if parent[0] < 0:
+				aRot[..., idx, :] = rRot[..., idx, :]
+				aLoc[..., idx, :] = loc
+			else:
+				aRot[..., idx, :] = quaternion.mul( aRot[..., parent, :], rRot[..., idx, :] )
+				aLoc[..., idx, :] = quaternion.transform( aRot[..., parent, :], loc ) + aLoc[..., parent, :]
+
+	def backward( self, aRot, aLoc, rRot, rLoc ):
+		# the relative pose of an absolute pose, the inverse of forward.
+		for (idx, parent) in self.levels:
+			if parent[0] < 0:
+				rRot[..., idx, :] = aRot[..., idx, :]
+				rLoc[..., idx, :] = aLoc[..., idx, :] - self.offsets[idx]
+			else:
+				inv = quaternion.conj( aRot[..., parent, :] )
+				rRot[..., idx, :] = quaternion.mul( inv, aRot[..., idx, :] )
+				rLoc[..., idx, :] = quaternion.transform( inv, aLoc[..., idx, :] - aLoc[..., parent, :] ) - self.offsets[idx]
+
+	def matrices( self, aRot, aLoc, out = None ):
+		# 4x4 matrices (column vectors) from the rest pose to the posed model
+		# space: rotation about the rest position of each bone followed by the
+		# move to its posed location.
+		r = quaternion.matrix4( aRot, out )
+		r[..., :3, 3] = aLoc - numpy.einsum( "...ij,...j->...i", r[..., :3, :3], self.pos )
+		return r
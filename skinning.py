@@ -0,0 +1,80 @@
+# by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
+
+import numpy
+import quaternion
+
+
+# deforms the vertices of a pmx.Loader (or the morphed ones, see
+# morphing.Morphing) by the bone matrices of skeleton.Skeleton.matrices.
+# the outputs (verts, norms) and the scratch
+# buffers are allocated once and overwritten by every update.
+#
+# BDEF1/2/4 vertices are blended linearly (the unused slots have weight 0).
+# SDEF vertices are rotated by the spherical blend of the two bone rotations
+# around C and translated by the linear blend of the R0 / R1 sides.
+class Skinning( object ):
+
+	def __init__( self, model ):
+		verts, weights = model.vertices()
+		N = weights.shape[0]
+		self.restVerts = numpy.array( verts.vert, dtype = numpy.float32 )
+		self.restNorms = numpy.array( verts.norm, dtype = numpy.float32 )
+		self.bones = numpy.where( weights.bone >= 0, weights.bone, 0 ).astype( numpy.intp )
+		self.weights = numpy.array( weights.weight, dtype = numpy.float32 )
+		# slots no vertex uses are skipped.
+		self.slots = [ k for k in range( 4 ) if numpy.any( self.weights[:, k] != 0.0 ) ]
+
+		self.verts = numpy.empty( (N, 3), numpy.float32 )
+		self.norms = numpy.empty( (N, 3), numpy.float32 )
+		self._mat = numpy.empty( (N, 3, 4), numpy.float32 )
+		self._tmp = numpy.empty( (N, 3, 4), numpy.float32 )
+
+		# SDEF constants.  see MMD's SDEF: the rotation center C, and the
+		# centers (C + r) / 2 of the bone sides after the R0 / R1 correction.
+		self.sdef = numpy.nonzero( weights.type == 3 )[0]
+		if len( self.sdef ) > 0:
+			w = self.weights[self.sdef, :2]
+			c, r0, r1 = numpy.array( weights.sdef[self.sdef], dtype = numpy.float32 ).transpose( (1, 0, 2) )
+			rw = r0 * w[:, 0:1] + r1 * w[:, 1:2]
+			self._sdefW = w
+			self._sdefC = c
+			self._sdefCr = numpy.stack( [
+				c + (r0 - rw) * 0.5,
+				c + (r1 - rw) * 0.5,
+			], axis = 1 )
+
+	def update( self, aMat, aRot, verts = None ):
+		if verts is None:
+			verts = self.restVerts
+		mat = self._mat
+		tmp = self._tmp
+		mat[:] = 0.0
+		for k in self.slots:
+			numpy.take( aMat[:, :3, :], self.bones[:, k], axis = 0, out = tmp )
+			tmp *= self.weights[:, k, None, None]
+			mat += tmp
+
+		numpy.einsum( "nij,nj->ni", mat[:, :, :3], verts, out = self.verts )
+		self.verts += mat[:, :, 3]
+		numpy.einsum( "nij,nj->ni", mat[:, :, :3], self.restNorms, out = self.norms )
+
+		if len( self.sdef ) > 0:
+			self._updateSdef( aMat, aRot, verts )
+
+		n = numpy.sqrt( numpy.einsum( "ni,ni->n", self.norms, self.norms ) )
+		self.norms /= numpy.maximum( n, 1e-12 )[:, None]
+
+	def _updateSdef( self, aMat, aRot, verts ):
+		idx = self.sdef
+		b0 = self.bones[idx, 0]
+		b1 = self.bones[idx, 1]
+		w = self._sdefW
+		q = quaternion.slerp( aRot[b0], aRot[b1], w[:, 1] )
+
+		m0 = aMat[b0, :3, :]
+		m1 = aMat[b1, :3, :]
+		cr = self._sdefCr
+		p0 = numpy.einsum( "nij,nj->ni", m0[:, :, :3], cr[:, 0] ) + m0[:, :, 3]
+		p1 = numpy.einsum( "nij,nj->ni", m1[:, :, :3], cr[:, 1] ) + m1[:, :, 3]
+		self.verts[idx] = quaternion.transform( q, verts[idx] - self._sdefC ) + p0 * w[:, 0:1] + p1 * w[:, 1:2]
+		self.norms[idx] = quaternion.transform( q, self.restNorms[idx] )
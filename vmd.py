@@ -1,24 +1,108 @@
 # by Yasuhiro Fujii <y-fujii at mimosa-pudica.net>, public domain
 
+import mmap
 import struct
+import threading
 import numpy
 import unicodedata
 
 
+# packed on-disk records
+boneKeyType = numpy.dtype( [
+	("name",   "S15"),
+	("frame",  "<i4"),
+	("loc",    "<f4", (3,)),
+	("rot",    "<f4", (4,)),
+	("interp", "u1", (64,)),
+] )
+
+skeyKeyType = numpy.dtype( [
+	("name",  "S15"),
+	("frame", "<i4"),
+	("val",   "<f4"),
+] )
+
+
+# parsed records
+boneType = numpy.dtype( [
+	("frame", numpy.int32),
+	("bone",  numpy.int32),
+	("loc",   numpy.float32, (3,)),
+	("rot",   numpy.float32, (4,)),
+	# bezier (x1, y1, x2, y2) of the curve ending at this key for X, Y, Z
+	# and the rotation, in [0, 1].
+	("interp", numpy.float32, (4, 4)),
+] )
+
+skeyType = numpy.dtype( [
+	("frame", numpy.int32),
+	("skey",  numpy.int32),
+	("val",   numpy.float32),
+] )
+
+
+def tracks( ids, N ):
+	# CSR index of frame-sorted keys by track: the keys of the track i are
+	# keys[order[offsets[i] : offsets[i + 1]]], sorted by frame.  keys of
+	# negative ids are not in any track.
+	order = numpy.argsort( ids, kind = "stable" )
+	order = order[ids[order] >= 0]
+	offsets = numpy.searchsorted( ids[order], numpy.arange( N + 1 ) )
+	return order, offsets
+
+
 class Loader( object ):
 
-	def load( self, file, boneMap, skeyMap ):
-		self._file = file
-		self.boneMap = boneMap
-		self.skeyMap = skeyMap
+	# bump when the parsed result changes (see cache.Cache)
+	version = 5
+
+	def load( self, file, boneMap = None, skeyMap = None, mapped = False ):
+		# keys refer to the bones / morphs of boneMap / skeyMap, or -1.  if
+		# they are None, the motion is independent of models: the maps are
+		# built from the names in the file and the keys refer to them (see
+		# Binding).
+		# if mapped, keyframe sections are decoded straight from the mapped
+		# file; the results are still copies as they are remapped and sorted.
+		if mapped:
+			self._map = mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ )
+			self._map.seek( file.tell() )
+			self._file = self._map
+		else:
+			self._map = None
+			self._file = file
+		self._initMaps( boneMap, skeyMap )
+		self._loadHeader()
+		self._loadBones()
+		self._loadSKeys()
+
+	def scan( self, file ):
+		# the packed records (boneKeyType, skeyKeyType) of the file, mapped
+		# and not parsed, and boneMap / skeyMap of their names.
+		self._map = mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ )
+		self._map.seek( file.tell() )
+		self._file = self._map
+		self._initMaps( None, None )
+		self._loadHeader()
+		N, = self._unpack( "I" )
+		bones = self._loadRecs( N, boneKeyType )
+		N, = self._unpack( "I" )
+		skeys = self._loadRecs( N, skeyKeyType )
+		self._lookup( bones["name"], self.boneMap, True )
+		self._lookup( skeys["name"], self.skeyMap, True )
+		return bones, skeys
+
+	def _initMaps( self, boneMap, skeyMap ):
+		self.boneMap = {} if boneMap is None else boneMap
+		self.skeyMap = {} if skeyMap is None else skeyMap
+		self._growBones = boneMap is None
+		self._growSKeys = skeyMap is None
+
+	def _loadHeader( self ):
 		magic = self._loadStr( 30 )
 		if not magic.startswith( "Vocaloid Motion Data" ):
 			raise ValueError()
 		self._loadStr( 20 )
 
-		self._loadBones()
-		self._loadSKeys()
-
 	def _unpack( self, fmt ):
 		return struct.unpack( fmt, self._file.read( struct.calcsize( fmt ) ) )
 
@@ -27,35 +111,171 @@ class Loader( object ):
 		i = s.index( b"\0" )
 		return str( s[:i], "cp932" )
 
+	def _loadRecs( self, N, dtype ):
+		if self._map is not None:
+			pos = self._file.tell()
+			recs = numpy.frombuffer( self._map, dtype, N, pos )
+			self._file.seek( pos + N * dtype.itemsize )
+			return recs
+
+		buf = self._file.read( N * dtype.itemsize )
+		if len( buf ) != N * dtype.itemsize:
+			raise ValueError()
+		return numpy.frombuffer( buf, dtype )
+
+	def _lookup( self, names, table, grow ):
+		# decode and normalize each distinct name only once.  if grow, unknown
+		# names are added to the table.
+		uniq, inv = numpy.unique( names, return_inverse = True )
+		idx = numpy.empty( uniq.shape, numpy.int32 )
+		for (i, s) in enumerate( uniq ):
+			name = unicodedata.normalize( "NFKC", str( s.split( b"\0" )[0], "cp932" ) )
+			idx[i] = table.setdefault( name, len( table ) ) if grow else table.get( name, -1 )
+		return idx[inv]
+
 	def _loadBones( self ):
 		N, = self._unpack( "I" )
-		bones = numpy.recarray( (N,), dtype = [
-			("frame", numpy.int32),
-			("bone",  numpy.int32),
-			("loc",   numpy.float32, (3,)),
-			("rot",   numpy.float32, (4,)),
-		] )
-		for i in range( N ):
-			name = unicodedata.normalize( "NFKC", self._loadStr( 15 ) )
-			bones[i].bone   = self.boneMap.get( name, -1 )
-			bones[i].frame  = self._unpack( "1i" )
-			bones[i].loc[:] = self._unpack( "3f" )
-			bones[i].rot[:] = self._unpack( "4f" )
-			self._loadStr( 64 )
-		
+		bones = self._boneKeys( self._loadRecs( N, boneKeyType ) )
 		self.bones = bones[numpy.argsort( bones.frame )]
+		self.boneOrder, self.boneOffsets = self._tracks( self.bones.bone, self.boneMap )
 
 	def _loadSKeys( self ):
 		N, = self._unpack( "I" )
-		skeys = numpy.recarray( (N,), dtype = [
-			("frame", numpy.int32),
-			("skey",  numpy.int32),
-			("val",   numpy.float32),
-		] )
-		for i in range( N ):
-			name = unicodedata.normalize( "NFKC", self._loadStr( 15 ) )
-			skeys[i].skey   = self.skeyMap.get( name, -1 )
-			skeys[i].frame, = self._unpack( "i" )
-			skeys[i].val,   = self._unpack( "f" )
-
+		skeys = self._skeyKeys( self._loadRecs( N, skeyKeyType ) )
 		self.skeys = skeys[numpy.argsort( skeys.frame )]
+		self.skeyOrder, self.skeyOffsets = self._tracks( self.skeys.skey, self.skeyMap )
+
+	def _tracks( self, ids, table ):
+		return tracks( ids, max( table.values(), default = -1 ) + 1 )
+
+	def _boneKeys( self, recs ):
+		bones = numpy.recarray( recs.shape, dtype = boneType )
+		bones.frame = recs["frame"]
+		bones.bone  = self._lookup( recs["name"], self.boneMap, self._growBones )
+		bones.loc   = recs["loc"]
+		bones.rot   = recs["rot"][:, [3, 0, 1, 2]] # (x, y, z, w) -> (w, x, y, z)
+		bones.interp = recs["interp"][:, :16].reshape( (-1, 4, 4) ).transpose( (0, 2, 1) ) / 127.0
+		return bones
+
+	def _skeyKeys( self, recs ):
+		skeys = numpy.recarray( recs.shape, dtype = skeyType )
+		skeys.frame = recs["frame"]
+		skeys.skey  = self._lookup( recs["name"], self.skeyMap, self._growSKeys )
+		skeys.val   = recs["val"]
+		return skeys
+
+
+# compact tables from the tracks of a motion to the bones and the morphs of a
+# pmx.Loader.  the keys of the track boneTracks[i] drive the bone bones[i],
+# and those of skeyTracks[i] the morph skeys[i]; tracks of names the model
+# does not have are dropped.
+class Binding( object ):
+
+	def __init__( self, motion, model ):
+		self.boneTracks, self.bones = self._bind( motion.boneMap, model.boneMap )
+		self.skeyTracks, self.skeys = self._bind( motion.skeyMap, model.skeyMap )
+
+	def _bind( self, tracks, table ):
+		pairs = sorted(
+			(track, table[name])
+			for (name, track) in list( tracks.items() )
+			if name in table
+		)
+		return (
+			numpy.array( [ t for (t, _) in pairs ], dtype = numpy.int32 ),
+			numpy.array( [ i for (_, i) in pairs ], dtype = numpy.int32 ),
+		)
+
+
+# file-like reader over an iterable of byte strings.
+class ChunkReader( object ):
+
+	def __init__( self, chunks ):
+		self._iter = iter( chunks )
+		self._buf = bytearray()
+
+	def read( self, N ):
+		while len( self._buf ) < N:
+			chunk = next( self._iter, None )
+			if chunk is None:
+				break
+			self._buf += chunk
+		s = bytes( self._buf[:N] )
+		del self._buf[:N]
+		return s
+
+
+class StreamLoader( Loader ):
+
+	# keyframes are decoded by chunks and merged into self.bones and
+	# self.skeys, which are replaced (never modified) by frame-sorted arrays
+	# of the keyframes decoded so far.  the track indices are set at the end,
+	# the offsets last, and then self.done.  so readers that see the offsets
+	# (read them first) also see the final keys.  if loading in a thread
+	# fails, self.error is the exception and self.done is set without the
+	# offsets.
+
+	def load( self, file, boneMap = None, skeyMap = None, chunk = 8192 ):
+		for _ in self.loadChunks( file, boneMap, skeyMap, chunk ):
+			pass
+
+	def start( self, file, boneMap = None, skeyMap = None, chunk = 8192 ):
+		# the state is initialized before the thread, so it can be polled
+		# at once.
+		self._reset( boneMap, skeyMap )
+		thread = threading.Thread( target = self._run, args = (file, chunk), daemon = True )
+		thread.start()
+		return thread
+
+	def loadChunks( self, file, boneMap = None, skeyMap = None, chunk = 8192 ):
+		self._reset( boneMap, skeyMap )
+		yield from self._chunks( file, chunk )
+
+	def _reset( self, boneMap, skeyMap ):
+		self._map = None
+		self._initMaps( boneMap, skeyMap )
+		self.bones = self._boneKeys( numpy.empty( (0,), boneKeyType ) )
+		self.skeys = self._skeyKeys( numpy.empty( (0,), skeyKeyType ) )
+		self.boneOrder = self.boneOffsets = None
+		self.skeyOrder = self.skeyOffsets = None
+		self.error = None
+		self.done = False
+
+	def _run( self, file, chunk ):
+		try:
+			for _ in self._chunks( file, chunk ):
+				pass
+		except Exception as e:
+			self.error = e
+			self.done = True
+
+	def _chunks( self, file, chunk ):
+		self._file = file if hasattr( file, "read" ) else ChunkReader( file )
+		self._loadHeader()
+
+		N, = self._unpack( "I" )
+		for bgn in range( 0, N, chunk ):
+			keys = self._boneKeys( self._loadRecs( min( chunk, N - bgn ), boneKeyType ) )
+			self.bones = self._merge( self.bones, keys )
+			yield
+
+		N, = self._unpack( "I" )
+		for bgn in range( 0, N, chunk ):
+			keys = self._skeyKeys( self._loadRecs( min( chunk, N - bgn ), skeyKeyType ) )
+			self.skeys = self._merge( self.skeys, keys )
+			yield
+
+		order, offsets = self._tracks( self.bones.bone, self.boneMap )
+		self.boneOrder = order
+		self.boneOffsets = offsets
+		order, offsets = self._tracks( self.skeys.skey, self.skeyMap )
+		self.skeyOrder = order
+		self.skeyOffsets = offsets
+		self.done = True
+
+	def _merge( self, keys, news ):
+		# both are runs sorted by frame: the new keys are inserted after the
+		# keys of the same frame, as a stable sort would.
+		news = news[numpy.argsort( news.frame, kind = "stable" )]
+		pos = numpy.searchsorted( keys.frame, news.frame, side = "right" )
+		return numpy.insert( keys, pos, news ).view( numpy.recarray )